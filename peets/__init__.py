@@ -1,3 +1,10 @@
-from peets._plugin import impl
-
 __all__ = ("impl")
+
+
+def __getattr__(name: str):
+    # 延迟导入，避免 `peets --help` 等场景加载所有插件依赖
+    if name == "impl":
+        from peets._plugin import impl
+
+        return impl
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
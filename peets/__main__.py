@@ -1,19 +1,15 @@
+import sys
 from argparse import ArgumentParser
-from itertools import chain, filterfalse
 from os import getcwd
 from pathlib import Path
-from typing import Iterator
+from typing import TYPE_CHECKING, Iterator
 
-from peets.entities import MediaEntity, Movie
-from peets.finder import traverse
-from peets.guessit import NonMedia, create_entity
-from peets.library import Library
-from peets.ui import Action
-from peets.ui.entry import interact
+if TYPE_CHECKING:
+    from peets.entities import MediaEntity
+    from peets.guessit import NonMedia
 
 
-def main():
-    parser = ArgumentParser(description="scrape movie")
+def _add_common_arguments(parser: ArgumentParser):
     parser.add_argument(
         "-l",
         "--library",
@@ -23,22 +19,111 @@ def main():
     )
     parser.add_argument("--naming", choices=["simple, full"], default="simple")
     parser.add_argument("targets", type=Path, nargs="+")
-    args = parser.parse_args()
+
+
+def main(argv: list[str] | None = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["watch"]:
+        return watch_main(argv[1:])
+
+    parser = ArgumentParser(
+        description="scrape movie", epilog="use `peets watch -h` for daemon mode"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes used to parse filenames, default is 1",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="only scan directories changed since the last complete run",
+    )
+    _add_common_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # 解析参数后才导入，`--help` 无需加载 guessit 及插件
+    from peets.finder import traverse
+    from peets.guessit import NonMedia, create_entities
+    from peets.library import Library
+    from peets.naming import BatchQueue
+    from peets.ui import Action
+    from peets.ui.entry import interact
 
     lib = Library(args.library)
-    processed = set((r.source for r in lib.record_list))
-    media_set: Iterator[tuple[Path, MediaEntity | NonMedia]] = (
-        (f, create_entity(f, processed=processed))
-        for f in chain(*map(traverse, args.targets))
+    processed = lib.processed()
+    # 文件操作在后台进行，交互处理下一个媒体时不需要等待
+    queue = BatchQueue(lib)
+    snapshot = lib.scan_snapshot if args.incremental else None
+    media_set: Iterator[tuple[Path, MediaEntity | NonMedia]] = create_entities(
+        traverse(*args.targets, snapshot=snapshot),
+        processed=processed,
+        jobs=args.jobs,
+        guess_cache=lib.guess_cache,
     )
 
-    for m in media_set:
-        if isinstance(m[1], NonMedia):
-            if any(m[0] == r.source for r in lib.record_list):
-                print(f"Ingore: {m[0]} processed.")
-        else:
-            if interact(m[1], lib) is Action.QUIT:
-                return
+    try:
+        for m in media_set:
+            if isinstance(m[1], NonMedia):
+                if lib.is_processed(m[0]):
+                    print(f"Ingore: {m[0]} processed.")
+            else:
+                if interact(m[1], lib, queue) is Action.QUIT:
+                    return
+                queue.commit()
+        queue.close()
+        # 只有完整处理后才更新，中途退出的文件下次仍会被遍历
+        if snapshot:
+            snapshot.save()
+    finally:
+        try:
+            # 退出前等待已提交的文件操作结束并记录
+            queue.close()
+        finally:
+            lib.guess_cache.close()
+
+
+def watch_main(argv: list[str]):
+    parser = ArgumentParser(
+        prog="peets watch", description="watch targets and scrape new media"
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=5.0,
+        help="seconds a file must stay unchanged after being written, default is 5",
+    )
+    _add_common_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from peets.guessit import NonMedia, create_entities
+    from peets.library import Library
+    from peets.ui import Action
+    from peets.ui.entry import interact
+    from peets.watch import watch
+
+    lib = Library(args.library)
+    try:
+        for f in watch(*args.targets, settle=args.settle):
+            if lib.is_processed(f):
+                print(f"Ingore: {f} processed.")
+                continue
+            # 每个文件单独创建，目录索引不能跨越长时间复用。
+            # processed 也只在单个文件内有效：创建 episode 时 tvshow 目录会被加入，
+            # 跨文件共用时之后到达的同一 tvshow 的 episode 都会被忽略
+            for _, m in create_entities([f], guess_cache=lib.guess_cache):
+                if isinstance(m, NonMedia):
+                    print(f"Ingore: {f} {m.name.lower()}.")
+                elif interact(m, lib) is Action.QUIT:
+                    return
+            lib.guess_cache.commit()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        lib.guess_cache.close()
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -14,6 +14,7 @@ class Op(Enum):
     Copy = auto()
     Reflink = auto()
     Move = auto()
+    Hardlink = auto()
 
 
 @dataclass
@@ -27,6 +28,8 @@ class Config:
     )
     media_file_naming_style = "simple"  # simple | follow_video
     op: Op = Op.Reflink
+    checksum: bool = False  # 复制时计算 BLAKE2 digest 并保存到 Record
+    verify: bool = False  # 复制后重新读取目标文件校验 digest，隐含 checksum
 
     def merge(self, new: Config | Path):
         pass
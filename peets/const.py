@@ -52,3 +52,17 @@ ARTWORK_FILE_TYPE = {
     "bmp",
     "webp"
 }
+
+# NAS 及操作系统生成的目录，遍历时不进入
+IGNORED_DIRS = {
+    "@eaDir",
+    "#recycle",
+    "#snapshot",
+    "$RECYCLE.BIN",
+    "System Volume Information",
+    "lost+found",
+}
+
+# 光盘目录结构，包含这些子目录的目录作为一个媒体
+DVD_FOLDER = "VIDEO_TS"
+BLURAY_FOLDER = "BDMV"
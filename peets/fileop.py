@@ -0,0 +1,291 @@
+"""
+文件操作的并发执行及调度
+
+按 (源设备, 目标设备) 分组，机械硬盘同时只有一个读写流，SSD、NFS 等允许多个；
+同一组内按文件在磁盘上的物理位置排序，减少磁头寻道。
+多次 submit 的操作在同一个队列中调度，设备空闲时才开始，不同磁盘之间互不等待。
+所有操作结束后按提交顺序返回结果，失败的操作汇总为 FileOpError
+"""
+import fcntl
+import os
+import struct
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache
+from pathlib import Path
+from typing import Callable, NamedTuple, TypeVar
+
+T = TypeVar("T")
+
+# linux/fiemap.h
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct("QQIIII")
+_FIEMAP_EXTENT = struct.Struct("QQQQQIIII")
+
+
+class FileOpError(Exception):
+    """
+    errors: 失败的操作的异常
+    results: 与提交顺序一致的结果，失败项为 None
+    """
+
+    def __init__(self, message: str, errors: list[Exception], results: list):
+        super().__init__(message)
+        self.errors = errors
+        self.results = results
+
+
+def _device(path: Path) -> int:
+    """
+    path 所在的设备，path 不存在时取最近的已存在的父目录
+    """
+    for p in (path, *path.parents):
+        try:
+            return os.stat(p).st_dev
+        except OSError:
+            continue
+    return -1
+
+
+@cache
+def rotational(dev: int) -> bool:
+    """
+    设备是否是机械硬盘，NFS、tmpfs 等没有块设备的返回 False
+    """
+    if dev < 0:
+        return False
+    block = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+    # 分区没有 queue，取所在的磁盘
+    for p in (block, os.path.join(os.path.realpath(block), "..")):
+        try:
+            with open(os.path.join(p, "queue", "rotational")) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+def position(path: Path) -> tuple[int, int]:
+    """
+    文件第一个 extent 的物理位置，不支持 FIEMAP 时（如 NFS、目录）退回 inode
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return (2, 0)
+    try:
+        buf = bytearray(
+            _FIEMAP_HEADER.pack(0, 2**64 - 1, 0, 0, 1, 0) + bytes(_FIEMAP_EXTENT.size)
+        )
+        fcntl.ioctl(fd, _FS_IOC_FIEMAP, buf, True)
+        if _FIEMAP_HEADER.unpack_from(buf)[3]:
+            return (0, _FIEMAP_EXTENT.unpack_from(buf, _FIEMAP_HEADER.size)[1])
+    except OSError:
+        pass
+    try:
+        return (1, os.fstat(fd).st_ino)
+    finally:
+        os.close(fd)
+
+
+_Op = tuple[Path, Path, Callable[..., T], tuple]
+_Lane = list[tuple[int, Callable[..., T], tuple]]
+
+
+class _Task(NamedTuple):
+    devices: tuple[int, ...]
+    lane: _Lane
+    stop: threading.Event
+    future: Future
+
+
+class FileOpRun:
+    """
+    一次 submit 的操作，result() 等待全部结束
+    """
+
+    def __init__(self, size: int) -> None:
+        self.stop = threading.Event()
+        self.futures: list[Future] = []
+        self.results: list = [None] * size
+        self.errors: list[Exception | None] = [None] * size
+        # 中断的原因，如 KeyboardInterrupt
+        self.interrupted: BaseException | None = None
+
+    def done(self) -> bool:
+        return all(f.done() for f in self.futures)
+
+    def cancel(self, interrupt: BaseException):
+        """
+        取消尚未开始的 lane，正在进行的 lane 完成当前操作后停止
+        """
+        self.interrupted = interrupt
+        self.stop.set()
+        for f in self.futures:
+            f.cancel()
+
+    def _collect(self, strict: bool = True):
+        for f in self.futures:
+            if f.cancelled() or (not strict and f.exception()):
+                continue
+            for i, result, error in f.result():
+                self.results[i], self.errors[i] = result, error
+
+    def result(self) -> list:
+        """
+        返回值与 ops 的顺序一致，有失败时抛出 FileOpError，
+        失败项为 None，或者 fn 抛出的 FileOpError 中已完成部分的结果。
+        等待期间被中断（如 KeyboardInterrupt）时取消尚未开始的操作，
+        等正在进行的操作结束后抛出 FileOpError，__cause__ 为原来的异常
+        """
+        try:
+            self._collect()
+        except BaseException as e:
+            self.cancel(e)
+            # 正在进行的操作无法中断，结束后其结果仍然需要返回给调用者记录
+            self._collect(strict=False)
+        failed = [e for e in self.errors if e]
+        if self.interrupted:
+            done = sum(r is not None for r in self.results)
+            raise FileOpError(
+                f"interrupted after {done} of {len(self.results)} file ops",
+                failed,
+                self.results,
+            ) from self.interrupted
+        if failed:
+            raise FileOpError(
+                f"{len(failed)} of {len(self.results)} file ops failed",
+                failed,
+                self.results,
+            ) from failed[0]
+        return self.results
+
+
+class FileOpExecutor:
+    """
+    workers: 线程池大小
+    per_device: 非机械硬盘上同时进行的操作数
+    """
+
+    def __init__(self, workers: int = 8, per_device: int = 4) -> None:
+        self.per_device = per_device
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="peets-fileop")
+        self._lock = threading.RLock()
+        self._devices: dict[int, threading.Semaphore] = {}
+        # 等待设备空闲的 lane，按提交顺序
+        self._waiting: list[_Task] = []
+
+    def streams(self, dev: int) -> int:
+        return 1 if rotational(dev) else self.per_device
+
+    def _semaphore(self, dev: int) -> threading.Semaphore:
+        with self._lock:
+            if dev not in self._devices:
+                self._devices[dev] = threading.Semaphore(self.streams(dev))
+            return self._devices[dev]
+
+    def _acquire(self, devices: tuple[int, ...]) -> bool:
+        # 全部获得或者全部不获得，不阻塞，lane 之间不会互相等待
+        acquired = []
+        for dev in devices:
+            if not self._semaphore(dev).acquire(blocking=False):
+                self._release(tuple(acquired))
+                return False
+            acquired.append(dev)
+        return True
+
+    def _release(self, devices: tuple[int, ...]):
+        for dev in devices:
+            self._semaphore(dev).release()
+
+    def _dispatch(self):
+        """
+        启动所有设备空闲的 lane。等待设备的 lane 不占用线程，
+        一块磁盘繁忙时其他磁盘的 lane 不会被阻塞
+        """
+        with self._lock:
+            waiting = []
+            for task in self._waiting:
+                if task.future.cancelled():
+                    continue
+                if not self._acquire(task.devices):
+                    waiting.append(task)
+                elif task.future.set_running_or_notify_cancel():
+                    self._pool.submit(self._run_lane, task)
+                else:
+                    self._release(task.devices)
+            self._waiting = waiting
+
+    def _run_lane(self, task: _Task):
+        out: list[tuple[int, object, Exception | None]] = []
+        try:
+            # 整个 lane 期间占用设备，保证顺序读写
+            for i, fn, args in task.lane:
+                # 被中断时不再开始新的操作，未执行的结果为 None
+                if task.stop.is_set():
+                    break
+                try:
+                    out.append((i, fn(*args), None))
+                except Exception as e:
+                    # 部分完成的操作带有已完成部分的结果
+                    partial = e.results if isinstance(e, FileOpError) else None
+                    out.append((i, partial, e))
+        except BaseException as e:
+            task.future.set_exception(e)
+        else:
+            task.future.set_result(out)
+        finally:
+            with self._lock:
+                self._release(task.devices)
+                self._dispatch()
+
+    def _plan(self, ops: list[_Op]) -> dict[tuple[int, int], list[_Lane]]:
+        groups: dict[tuple[int, int], list[tuple[tuple[int, int], int]]] = {}
+        for i, (src, dst, _, _) in enumerate(ops):
+            devices = (_device(src), _device(dst))
+            groups.setdefault(devices, []).append((position(src), i))
+        plan = {}
+        for devices, items in groups.items():
+            items.sort()
+            n = min(map(self.streams, devices))
+            # 轮流分配，每个 lane 内仍然按位置有序
+            plan[devices] = [
+                [(i, ops[i][2], ops[i][3]) for _, i in items[k::n]] for k in range(n)
+            ]
+        return plan
+
+    def submit(self, ops: list[_Op]) -> FileOpRun:
+        """
+        提交 ops: [(src, dst, fn, args)]，不等待
+
+        src、dst 用于确定设备及顺序，dst 可以不存在。
+        提交期间被中断时已提交的操作不再开始，由 FileOpRun.result() 抛出
+        """
+        run = FileOpRun(len(ops))
+        try:
+            for devices, lanes in self._plan(ops).items():
+                for lane in filter(None, lanes):
+                    future: Future = Future()
+                    run.futures.append(future)
+                    with self._lock:
+                        self._waiting.append(
+                            _Task(tuple(sorted(set(devices))), lane, run.stop, future)
+                        )
+                        self._dispatch()
+        except BaseException as e:
+            run.cancel(e)
+        return run
+
+    def run(self, ops: list[_Op]) -> list[T]:
+        """
+        执行 ops 并等待全部结束，见 submit 及 FileOpRun.result
+        """
+        return self.submit(ops).result()
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+
+@cache
+def default_executor() -> FileOpExecutor:
+    return FileOpExecutor()
@@ -1,7 +1,17 @@
+import os
+import pickle
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterator
-from itertools import chain
-from peets.const import ARTWORK_FILE_TYPE, SUBTITLE_CONTAINERS, VIDEO_CONTAINERS
+from typing import Iterator, NamedTuple
+
+from peets.const import (
+    ARTWORK_FILE_TYPE,
+    BLURAY_FOLDER,
+    DVD_FOLDER,
+    IGNORED_DIRS,
+    SUBTITLE_CONTAINERS,
+    VIDEO_CONTAINERS,
+)
 
 
 def is_video(path: Path) -> bool:
@@ -13,19 +23,191 @@ def is_subtitle(path: Path) -> bool:
 def is_artwork_file(path: Path) -> bool:
     return path.suffix[1:] in ARTWORK_FILE_TYPE
 
-def _file_traverse(target:Path)->Iterator[Path]:
+def is_ignored(name: str) -> bool:
+    return name.startswith(".") or name in IGNORED_DIRS
+
+
+_Listing = tuple[list[os.DirEntry], list[os.DirEntry]]
+
+
+def scan_dir(path: str) -> _Listing:
+    """
+    列出目录，返回 (files, dirs)，隐藏及忽略的条目在此处就被丢弃，不会再进入
+    """
+    files: list[os.DirEntry] = []
+    dirs: list[os.DirEntry] = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if is_ignored(entry.name):
+                    continue
+                try:
+                    # 不跟随目录的软链接，避免循环
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry)
+                    elif entry.is_file():
+                        files.append(entry)
+                except OSError:
+                    pass
+    except OSError:
+        # 无权限或遍历时被删除
+        return [], []
+    files.sort(key=lambda e: e.name)
+    dirs.sort(key=lambda e: e.name)
+    return files, dirs
+
+
+def is_disc(dirs: list[os.DirEntry]) -> bool:
+    """
+    根据子目录判断是否是 DVD（VIDEO_TS）或 Blu-ray（BDMV/STREAM）的目录结构
+    """
+    for d in dirs:
+        name = d.name.upper()
+        if name == DVD_FOLDER:
+            return True
+        if name == BLURAY_FOLDER and os.path.isdir(os.path.join(d.path, "STREAM")):
+            return True
+    return False
+
+
+def _media(files: list[os.DirEntry]) -> list[str]:
+    return [f.path for f in files if is_video(Path(f.name))]
+
+
+class DirState(NamedTuple):
+    mtime: int
+    ino: int
+    videos: dict[str, tuple[int, int]]  # name -> (size, mtime)
+    dirs: list[str]
+    disc: bool = False
+
+
+class ScanSnapshot:
+    """
+    记录上一次遍历时每个目录的 mtime 及 inode
+
+    目录的 mtime 只在其直接子项增删或改名时变化，未变化的目录无需重新列出，
+    只需按记录的子目录继续检查。原地修改文件内容不会改变目录的 mtime，不会被发现。
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._dirs: dict[str, DirState] = {}
+        if path.exists():
+            with path.open("rb") as f:
+                self._dirs = pickle.load(f)
+
+    def scan(self, path: str) -> tuple[list[str], list[str]]:
+        """
+        返回目录内新增或修改的媒体，及需要继续检查的子目录
+        """
+        key = os.path.abspath(path)
+        try:
+            # 先 stat 再列出，列出期间的变化会在下一次被发现
+            st = os.stat(path)
+        except OSError:
+            self._dirs.pop(key, None)
+            return [], []
+        prev = self._dirs.get(key)
+        if prev and (prev.mtime, prev.ino) == (st.st_mtime_ns, st.st_ino):
+            return [], [os.path.join(path, d) for d in prev.dirs]
+
+        files, dirs = scan_dir(path)
+        if is_disc(dirs):
+            self._dirs[key] = DirState(st.st_mtime_ns, st.st_ino, {}, [], True)
+            # 只有新出现的光盘目录才返回
+            return ([] if prev and prev.disc else [path]), []
+
+        videos: dict[str, tuple[int, int]] = {}
+        changed = []
+        for e in files:
+            if not is_video(Path(e.name)):
+                continue
+            try:
+                est = e.stat()
+            except OSError:
+                continue
+            videos[e.name] = (est.st_size, est.st_mtime_ns)
+            if not prev or prev.videos.get(e.name) != videos[e.name]:
+                changed.append(e.path)
+        self._dirs[key] = DirState(
+            st.st_mtime_ns, st.st_ino, videos, [d.name for d in dirs]
+        )
+        return changed, [d.path for d in dirs]
+
+    def save(self):
+        tmp = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(self._dirs, f)
+        tmp.replace(self.path)
+
+
+def _scan(path: str, snapshot: ScanSnapshot | None) -> tuple[list[str], list[str]]:
+    if snapshot:
+        return snapshot.scan(path)
+    files, dirs = scan_dir(path)
+    if is_disc(dirs):
+        # 光盘目录作为一个整体，不再深入
+        return [path], []
+    return _media(files), [d.path for d in dirs]
+
+
+def _submit(
+    executor: Executor | None, path: str, snapshot: ScanSnapshot | None
+) -> Future:
+    if executor:
+        return executor.submit(_scan, path, snapshot)
+    future: Future = Future()
+    future.set_result(_scan(path, snapshot))
+    return future
+
+
+def walk(
+    target: Path,
+    executor: Executor | None = None,
+    snapshot: ScanSnapshot | None = None,
+) -> Iterator[str]:
+    """
+    基于 os.scandir 的深度优先遍历，yield 视频文件及光盘目录的路径
+
+    子目录的列表会提前提交到 executor，与当前目录的消费并行；
+    结果顺序与单线程遍历一致（按名称排序的先序遍历）。
+    指定 snapshot 时只进入有变化的目录，只返回新增或修改的视频文件。
+    """
+    stack = [_submit(executor, str(target), snapshot)]
+    while stack:
+        media, dirs = stack.pop().result()
+        # 逆序入栈，保证先处理名称靠前的目录
+        stack.extend(_submit(executor, d, snapshot) for d in reversed(dirs))
+        yield from media
+
+
+def _file_traverse(
+    target: Path, executor: Executor | None, snapshot: ScanSnapshot | None
+) -> Iterator[Path]:
     if target.is_dir():
-        yield from (f for f in target.glob("**/*")
-                    if Path.is_file and not any(part.startswith('.') for part in f.parts))
-    else:
+        yield from (Path(p) for p in walk(target, executor, snapshot))
+    elif is_video(target):
         yield target
 
-def traverse(*args:Path)->Iterator[Path]:
+
+def traverse(
+    *args: Path, workers: int | None = None, snapshot: ScanSnapshot | None = None
+) -> Iterator[Path]:
     """
-    find all media file in args
+    find all media file in args, DVD/Blu-ray 目录作为一个媒体返回
 
+    workers: 遍历目录使用的线程数，None 为 ThreadPoolExecutor 的默认值，1 为单线程
+    snapshot: 增量遍历，只返回上次遍历后新增或修改的文件，遍历结果会更新到 snapshot
     """
-    return (target
-            for target in chain(*(_file_traverse(f) for f in args))
-            if is_video(target)
-            )
+    executor = ThreadPoolExecutor(workers) if workers != 1 else None
+    seen: set[Path] = set()
+    try:
+        for target in args:
+            for f in _file_traverse(target, executor, snapshot):
+                if f not in seen:
+                    seen.add(f)
+                    yield f
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
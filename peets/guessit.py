@@ -1,10 +1,18 @@
+import multiprocessing
 import os
-from collections.abc import Iterable
+import pickle
+import sqlite3
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
-from itertools import chain
+from functools import cache
+from importlib.metadata import version
+from itertools import chain, islice
 from pathlib import Path
 from pprint import pprint as pp
-from typing import Any, TypeVar
+from typing import Any, NamedTuple, TypeVar
 
 import regex
 from guessit.api import GuessItApi, guessit, merge_options
@@ -16,7 +24,7 @@ from rebulk.match import Match
 
 from peets.entities import MediaEntity, MediaFileType, Movie, TvShow, TvShowEpisode
 from peets.error import UnknownMediaTypeError
-from peets.finder import is_artwork_file, is_subtitle, is_video, traverse
+from peets.finder import is_artwork_file, is_subtitle, is_video, scan_dir
 from peets.merger import ConvertTable, Option, create
 
 # use regex replace re
@@ -64,30 +72,419 @@ class _TittleSplitRule(CustomRule):
         matches.append(Match(m.end() + 1, _end, name="original_title", value=origin))
 
 
-# FIXME multiple file movie
-def create_entity(path: Path, processed: set = set()) -> MediaEntity | NonMedia:
+def _custom_rebulk(config):
+    rebulk = rebulk_builder(config)
+    rebulk.rules(_TittleSplitRule)
+    return rebulk
+
+
+@cache
+def _parser() -> tuple[GuessItApi, dict]:
     """
-    one file one movie
+    构建 rebulk 的开销远大于单次匹配，每个进程只构建一次
     """
-    if path.absolute() in processed:
-        return NonMedia.PROCESSED
-
-    # 只能处理视频文件
     api = GuessItApi()
-
-    def custom_rebulk(config):
-        rebulk = rebulk_builder(config)
-        rebulk.rules(_TittleSplitRule)
-        return rebulk
-
     config = api.configure(
-        options={}, rules_builder=custom_rebulk, sanitize_options=False
+        options={}, rules_builder=_custom_rebulk, sanitize_options=False
     )
+    return api, config
+
+
+def guess_file(path: Path) -> dict:
+    api, config = _parser()
     options = merge_options(config, {})
+    # 转为 dict，MatchesDict 不能被 pickle
+    return dict(api.rebulk.matches(str(path), options).to_dict())
+
+
+# 修改 _TittleSplitRule 等自定义规则后需要递增，使旧的缓存失效
+_RULES_VERSION = 1
+
+
+@cache
+def parser_version() -> str:
+    return f"{version('guessit')}-{version('rebulk')}-{_RULES_VERSION}"
+
+
+class GuessCache:
+    """
+    guess_file 结果的持久化缓存
+
+    以解析时的路径字符串为 key：guessit 的结果取决于传入的字符串，
+    相对路径（如 01.mkv）缺少上级目录中的标题，不能与绝对路径共用结果。
+    文件大小、mtime 或 parser 版本任意变化都视为失效
+    """
+
+    _COMMIT_EVERY = 256
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS guess ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,"
+            " version TEXT, data BLOB)"
+        )
+        self._dirty = 0
+
+    @staticmethod
+    def _key(path: Path) -> tuple[str, int, int] | None:
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        # 与 guess_file 解析的字符串一致
+        return str(path), st.st_size, st.st_mtime_ns
+
+    def get(self, path: Path) -> dict | None:
+        if not (key := self._key(path)):
+            return None
+        row = self._conn.execute(
+            "SELECT size, mtime, version, data FROM guess WHERE path = ?", key[:1]
+        ).fetchone()
+        if row and tuple(row[:3]) == (*key[1:], parser_version()):
+            return pickle.loads(row[3])
+        return None
+
+    def put(self, path: Path, guess: dict):
+        if not (key := self._key(path)):
+            return
+        self._conn.execute(
+            "INSERT OR REPLACE INTO guess VALUES (?, ?, ?, ?, ?)",
+            (*key, parser_version(), pickle.dumps(guess)),
+        )
+        self._dirty += 1
+        if self._dirty >= self._COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self._conn.commit()
+        self._dirty = 0
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+
+def _guess_chunk(paths: list[Path]) -> list[dict]:
+    return [guess_file(p) for p in paths]
+
+
+def _cached_guess(path: Path, guess_cache: GuessCache | None) -> dict:
+    if guess_cache is None:
+        return guess_file(path)
+    if (guess := guess_cache.get(path)) is None:
+        guess = guess_file(path)
+        guess_cache.put(path, guess)
+    return guess
+
+
+def _parallel_guess(
+    paths: Iterable[Path],
+    jobs: int,
+    guess_cache: GuessCache | None = None,
+    chunksize: int = 16,
+) -> Iterator[tuple[Path, dict]]:
+    """
+    多进程解析文件名，结果按 paths 的顺序返回
+
+    只保持有限的任务在队列中，paths 可以是惰性的；命中缓存的文件不提交给子进程
+    """
+    it = iter(paths)
+    pending: deque[tuple[list[Path], list[dict | None], Future | None]] = deque()
+    # 扫描目录的线程此时仍在运行，fork 可能复制到被持有的锁
+    context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(
+        jobs, mp_context=context, initializer=_parser
+    ) as executor:
+        while True:
+            while len(pending) < jobs * 4 and (chunk := list(islice(it, chunksize))):
+                hits = [guess_cache.get(p) if guess_cache else None for p in chunk]
+                misses = [p for p, h in zip(chunk, hits) if h is None]
+                future = executor.submit(_guess_chunk, misses) if misses else None
+                pending.append((chunk, hits, future))
+            if not pending:
+                return
+            chunk, hits, future = pending.popleft()
+            parsed = iter(future.result() if future else [])
+            for p, guess in zip(chunk, hits):
+                if guess is None:
+                    guess = next(parsed)
+                    if guess_cache:
+                        guess_cache.put(p, guess)
+                yield p, guess
+
+
+class IndexedFile(NamedTuple):
+    type: MediaFileType
+    path: Path
+    stem: str
+    suffix: str
+
+
+# stem 与后缀之间的分隔符，如 `.zh.srt`，`-poster.jpg`
+_SIDECAR_SEPARATORS = ".-_ "
+
+
+def _longest_prefix(stem: str, videos: dict[str, Path]) -> Path | None:
+    """
+    找出 stem 以其为前缀（在分隔符处截断）的最长的视频
+    """
+    if stem in videos:
+        return videos[stem]
+    for i in range(len(stem) - 1, 0, -1):
+        if stem[i] in _SIDECAR_SEPARATORS and (owner := videos.get(stem[:i])):
+            return owner
+    return None
+
+
+class DirIndex:
+    """
+    目录 -> 已分类的子文件
+
+    一次扫描共用一个 DirIndex，每个目录只列出及分类一次，目录名也只解析一次
+    """
+
+    def __init__(self) -> None:
+        self._dirs: dict[Path, tuple[list[IndexedFile], list[Path]]] = {}
+        self._owners: dict[Path, dict[Path, list[IndexedFile]]] = {}
+        self._guesses: dict[Path, dict] = {}
+
+    def guess_dir(self, dir_: Path) -> dict:
+        """
+        目录名的解析结果，调用方不应修改返回值
+        """
+        if (guess := self._guesses.get(dir_)) is None:
+            guess = self._guesses[dir_] = guessit(dir_)
+        return guess
+
+    def _list(self, dir_: Path) -> tuple[list[IndexedFile], list[Path]]:
+        if (listing := self._dirs.get(dir_)) is None:
+            files, dirs = scan_dir(str(dir_))
+            children = (
+                (parse_mediafile_type(p), p)
+                for p in (dir_.joinpath(e.name) for e in files)
+            )
+            listing = self._dirs[dir_] = (
+                [
+                    IndexedFile(t, p, p.stem, p.suffix)
+                    for t, p in children
+                    if t is not MediaFileType.UNKNOWN
+                ],
+                [dir_.joinpath(e.name) for e in dirs],
+            )
+        return listing
+
+    def children(self, dir_: Path) -> list[IndexedFile]:
+        """
+        目录内已识别类型的文件，不包括 UNKNOWN
+        """
+        return self._list(dir_)[0]
+
+    def sidecars(self, video: Path) -> list[IndexedFile]:
+        """
+        目录内属于 video 的其他文件（字幕、图片、nfo、trailer 等）
+
+        每个文件只属于 stem 最长匹配的视频，如 `Movie 2.zh.srt` 属于 `Movie 2.mkv`
+        而不是 `Movie.mkv`
+        """
+        dir_ = video.parent
+        if (owners := self._owners.get(dir_)) is None:
+            children = self.children(dir_)
+            videos = {c.stem: c.path for c in children if c.type is MediaFileType.VIDEO}
+            owners = self._owners[dir_] = {}
+            for c in children:
+                if c.type is not MediaFileType.VIDEO and (
+                    owner := _longest_prefix(c.stem, videos)
+                ):
+                    owners.setdefault(owner, []).append(c)
+        return owners.get(video, [])
+
+    def videos(self, dir_: Path) -> Iterator[Path]:
+        """
+        递归找出目录内所有视频文件，与 traverse 相同
+        """
+        files, dirs = self._list(dir_)
+        yield from (f.path for f in files if is_video(f.path))
+        for d in dirs:
+            yield from self.videos(d)
+
+
+def create_entities(
+    paths: Iterable[Path],
+    processed: set | None = None,
+    jobs: int = 1,
+    guess_cache: GuessCache | None = None,
+) -> Iterator[tuple[Path, MediaEntity | NonMedia]]:
+    """
+    批量创建，所有文件共用同一个 processed 及 parser
+
+    jobs > 1 时文件名的解析分布到多个进程，返回顺序与 paths 一致
+    guess_cache: 持久化的解析结果，命中时不再解析
+    """
+    processed = set() if processed is None else processed
+    index = DirIndex()
+    guesses: Iterable[tuple[Path, dict | None]]
+    if jobs > 1:
+        guesses = _parallel_guess(paths, jobs, guess_cache)
+    else:
+        guesses = (
+            (p, None if p.absolute() in processed else _cached_guess(p, guess_cache))
+            for p in paths
+        )
+    yield from _cluster(guesses, processed, index)
+
+
+@dataclass
+class _Cluster:
+    """
+    属于同一 tvshow 的 episode
+    """
+
+    key: tuple[str, Path]
+    tvshow_path: Path | None
+    tvshow_guess: dict
+    # (path, guess)
+    members: list[tuple[Path, dict | None]] = field(default_factory=list)
+
+    def create(self, processed: set, index: DirIndex) -> TvShow:
+        if self.tvshow_path:
+            return _create_tvshow_batch(
+                self.tvshow_guess, self.tvshow_path, processed, index, self.members
+            )
+        # 情况3，同一目录下同名的 episode 合并为一个 tvshow
+        self.tvshow_guess["episodes"] = [
+            _do_create(processed, p, TvShowEpisode, e_addon)
+            for path, guess in self.members
+            for p, e_addon in _do_guess_episode(path, index, guess)
+        ]
+        return _do_create(processed, self.members[0][0], TvShow, self.tvshow_guess)
+
+
+@dataclass
+class _Scope:
+    """
+    第一个 episode 所在的范围，范围内每个 (tvshow title, root) 一个 cluster
+
+    root 为 tvshow 目录时，其下的文件都在范围内；
+    找不到 tvshow 目录时 root 为 episode 所在目录，只包括其直接子文件
+    """
 
-    matches = api.rebulk.matches(str(path), options)
+    root: Path
+    recursive: bool
+    clusters: dict[tuple[str, Path], _Cluster] = field(default_factory=dict)
+    # (path, guess, cluster key)
+    items: list[tuple[Path, dict | None, tuple[str, Path] | None]] = field(
+        default_factory=list
+    )
+
+    def contains(self, path: Path) -> bool:
+        if self.recursive:
+            return path.is_relative_to(self.root)
+        return path.parent == self.root
+
+    def add(
+        self,
+        path: Path,
+        guess: dict | None,
+        episode: tuple[tuple[str, Path], Path | None, dict] | None,
+    ):
+        key = None
+        if episode:
+            key = episode[0]
+            if key not in self.clusters:
+                self.clusters[key] = _Cluster(*episode)
+            self.clusters[key].members.append((path, guess))
+        self.items.append((path, guess, key))
+
+    def flush(
+        self, processed: set, index: DirIndex
+    ) -> Iterator[tuple[Path, MediaEntity | NonMedia]]:
+        created: set[tuple[str, Path]] = set()
+        for path, guess, key in self.items:
+            if key is None:
+                yield path, _entity(path, guess, processed, index)
+            elif key in created:
+                yield path, NonMedia.PROCESSED
+            else:
+                created.add(key)
+                yield path, self.clusters[key].create(processed, index)
+
+
+def _entity(
+    path: Path, guess: dict | None, processed: set, index: DirIndex
+) -> MediaEntity | NonMedia:
+    if guess is None:
+        return NonMedia.PROCESSED
+    return create_entity(path, processed, guess, index)
+
+
+def _episode_key(
+    path: Path, guess: dict | None, processed: set, index: DirIndex
+) -> tuple[tuple[str, Path], Path | None, dict] | None:
+    """
+    可以聚类的 episode 返回 ((tvshow title, root), tvshow_path, tvshow_guess)
+    """
+    if (
+        guess is None
+        or guess.get("type") != "episode"
+        or not _is_feature(guess)
+        or not (title := _first(guess.get("title")))
+        or path.absolute() in processed
+        or path.parent in processed
+        or path.parent.parent in processed
+    ):
+        return None
+    tvshow_path, tvshow_guess = _find_tvshow(guess, path, index)
+    return (title.casefold(), tvshow_path or path.parent), tvshow_path, tvshow_guess
+
+
+def _cluster(
+    guesses: Iterable[tuple[Path, dict | None]], processed: set, index: DirIndex
+) -> Iterator[tuple[Path, MediaEntity | NonMedia]]:
+    """
+    单次遍历将 episode 按 (tvshow title, 目录) 聚类，每个 cluster 创建一个 tvshow
 
-    guess = matches.to_dict()
+    traverse 是深度优先的，同一范围内的文件是连续的，离开范围时创建范围内所有的 tvshow
+    """
+    scope: _Scope | None = None
+    for path, guess in guesses:
+        if scope and scope.contains(path):
+            scope.add(path, guess, _episode_key(path, guess, processed, index))
+            continue
+        if scope:
+            yield from scope.flush(processed, index)
+            scope = None
+        if episode := _episode_key(path, guess, processed, index):
+            (_, root), tvshow_path, _ = episode
+            scope = _Scope(root, tvshow_path is not None)
+            scope.add(path, guess, episode)
+        else:
+            yield path, _entity(path, guess, processed, index)
+    if scope:
+        yield from scope.flush(processed, index)
+
+
+# FIXME multiple file movie
+def create_entity(
+    path: Path,
+    processed: set = set(),
+    guess: dict | None = None,
+    index: DirIndex | None = None,
+) -> MediaEntity | NonMedia:
+    """
+    one file one movie
+
+    guess: 预先解析好的 guess_file 结果
+    index: 同一次扫描共用的 DirIndex
+    """
+    if path.absolute() in processed:
+        return NonMedia.PROCESSED
+    index = index or DirIndex()
+
+    # 只能处理视频文件
+    if guess is None:
+        guess = guess_file(path)
 
     # 非正片会被忽略，后续会通过关联的正片找到
     # 如果找不到，说明是独立的影片，是否没有入库的意义
@@ -98,9 +495,9 @@ def create_entity(path: Path, processed: set = set()) -> MediaEntity | NonMedia:
             case {"other": "Sample"} | {"other": ["Sample", *_]}:
                 return NonMedia.SAMPLE
             case {"type": "movie"}:
-                return _create_movie(guess, path, processed)
+                return _create_movie(guess, path, processed, index)
             case {"type": "episode"}:
-                return _create_tvshow(guess, path, processed)
+                return _create_tvshow(guess, path, processed, index)
             case _:
                 raise UnknownMediaTypeError(guess)
     except _ProcessedException:
@@ -127,20 +524,25 @@ def parse_mediafile_type(path: Path) -> MediaFileType:
     return MediaFileType.UNKNOWN
 
 
-def _create_movie(guess: dict, path: Path, processed: set) -> Movie:  # type: ignore
-    # 找出相关的 MediaFile
-    mfs = [
-        (parse_mediafile_type(child), child)
-        for child in path.parent.iterdir()
-        if child != path
-    ]
-    mfs = [c for c in mfs if c[0] is not MediaFileType.UNKNOWN]
-    # 如果有存在 trailer 或者 sample 之外的视频存在，则认为目录存放有多个视频文件
-    multi_movie_dir = bool(mfs) and MediaFileType.VIDEO in next(zip(*mfs))
+def _create_movie(
+    guess: dict, path: Path, processed: set, index: DirIndex
+) -> Movie:  # type: ignore
+    if path.is_dir():
+        # 光盘目录，相关的 MediaFile 在光盘目录内
+        mfs = [(c.type, c.path) for c in index.children(path)]
+        guess["is_disc"] = True
+        multi_movie_dir = False
+    else:
+        # 找出相关的 MediaFile
+        mfs = [
+            (c.type, c.path) for c in index.children(path.parent) if c.path != path
+        ]
+        # 如果有存在 trailer 或者 sample 之外的视频存在，则认为目录存放有多个视频文件
+        multi_movie_dir = bool(mfs) and MediaFileType.VIDEO in next(zip(*mfs))
     # 如果是 mmd 则 mediafile 中含有当前文件名的才能被认为是属于当前的资源
     if multi_movie_dir:
         # mmd 目录，名称相同才会被认为是相关的 MediaFile
-        mfs = [c for c in mfs if path.stem in c[1].stem and c[0] != MediaFileType.VIDEO]
+        mfs = [(c.type, c.path) for c in index.sidecars(path)]
         guess["multi_movie_dir"] = True
 
     mfs.append((MediaFileType.VIDEO, path))
@@ -150,7 +552,7 @@ def _create_movie(guess: dict, path: Path, processed: set) -> Movie:  # type: ig
     return _do_create(processed, path, Movie, guess)
 
 
-def _create_tvshow(guess, path: Path, processed: set) -> TvShow:
+def _create_tvshow(guess, path: Path, processed: set, index: DirIndex) -> TvShow:
     episode_guess = guess
     # 预设可能目录情况有三种
     # 1. tvshow/season/episode
@@ -165,49 +567,70 @@ def _create_tvshow(guess, path: Path, processed: set) -> TvShow:
         # 当前剧集已被处理，抛出异常
         raise _ProcessedException()
 
-    tvshow_path = None
-    # FIXME 不可靠
-    def _is_tvshow_of(episode, maybe) -> dict | None:
-        tvshow_guess = guessit(maybe)
-        # episode 可能有两个标题第一个是 tvshow 第二个是 episode
-        title = (
-            episode["title"][0] if type(episode["title"]) is list else episode["title"]
-        )
-        if (
-            "title" in tvshow_guess
-            and type(tvshow_guess["title"]) is str
-            and tvshow_guess["title"].casefold() == title.casefold()
-        ):
-            return tvshow_guess
-
-    if tvshow_guess := _is_tvshow_of(episode_guess, tvshow_maybe):
-        tvshow_path = tvshow_maybe
-    elif tvshow_guess := _is_tvshow_of(episode_guess, season_maybe):
-        tvshow_path = season_maybe
-    else:
-        tvshow_guess = episode_guess
+    tvshow_path, tvshow_guess = _find_tvshow(episode_guess, path, index)
 
     if tvshow_path:
-        return _create_tvshow_batch(tvshow_guess, tvshow_path, processed)
+        return _create_tvshow_batch(tvshow_guess, tvshow_path, processed, index)
     else:
         # 情况3
         tvshow_guess["episodes"] = [
             _do_create(processed, path, TvShowEpisode, e_addon)
-            for _, e_addon in _do_guess_episode(path, episode_guess)
+            for _, e_addon in _do_guess_episode(path, index, episode_guess)
         ]
         tvshow = _do_create(processed, path, TvShow, tvshow_guess)
         return tvshow
 
 
-def _create_tvshow_batch(tvshow_guess, path: Path, processed: set) -> TvShow:
+# FIXME 不可靠
+def _find_tvshow(
+    episode: dict, path: Path, index: DirIndex
+) -> tuple[Path | None, dict]:
+    """
+    在上两级目录中找出 tvshow 目录，返回 (tvshow_path, tvshow_guess)
+    找不到时返回 (None, episode)
+    """
+    # episode 可能有两个标题第一个是 tvshow 第二个是 episode
+    title = _first(episode.get("title"))
+    for maybe in (path.parent.parent, path.parent):
+        tvshow_guess = index.guess_dir(maybe)
+        if (
+            title
+            and "title" in tvshow_guess
+            and type(tvshow_guess["title"]) is str
+            and tvshow_guess["title"].casefold() == title.casefold()
+        ):
+            return maybe, dict(tvshow_guess)
+    return None, episode
+
+
+def _first(value):
+    return value[0] if type(value) is list else value
+
+
+def _is_feature(guess: dict) -> bool:
+    return "other" not in guess or (
+        "Trailer" not in guess["other"] and "Sample" not in guess["other"]
+    )
+
+
+def _create_tvshow_batch(
+    tvshow_guess,
+    path: Path,
+    processed: set,
+    index: DirIndex,
+    members: list[tuple[Path, dict]] | None = None,
+) -> TvShow:
+    """
+    members: 已解析的 episode，没有则找出 tvshow 目录下所有的视频文件
+    """
+    if members is None:
+        members = [(media, guess_file(media)) for media in index.videos(path)]
     episodes: list[TvShowEpisode] = [
         _do_create(processed, p, TvShowEpisode, guess)
-        for p, guess in chain(*(_do_guess_episode(media) for media in traverse(path)))
-        if guess["type"] == "episode"
-        and (
-            "other" not in guess
-            or ("Trailer" not in guess["other"] and "Sample" not in guess["other"])
+        for p, guess in chain(
+            *(_do_guess_episode(media, index, addon) for media, addon in members)
         )
+        if guess["type"] == "episode" and _is_feature(guess)
     ]
 
     tvshow_guess["episodes"] = episodes
@@ -215,13 +638,10 @@ def _create_tvshow_batch(tvshow_guess, path: Path, processed: set) -> TvShow:
     return tvshow
 
 
-def _do_guess_episode(path: Path, addon: dict | None = None) -> list[tuple[Path, dict]]:
-    mfs = [
-        (parse_mediafile_type(child), child)
-        for child in path.parent.iterdir()
-        if child != path and child.stem.startswith(path.stem)
-    ]
-    mfs = [c for c in mfs if c[0] is not MediaFileType.UNKNOWN]
+def _do_guess_episode(
+    path: Path, index: DirIndex, addon: dict | None = None
+) -> list[tuple[Path, dict]]:
+    mfs = [(c.type, c.path) for c in index.sidecars(path)]
     mfs.append((MediaFileType.VIDEO, path))
     if not addon:
         addon = guessit(path)
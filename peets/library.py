@@ -1,12 +1,49 @@
 from __future__ import annotations
 
+import os
 import pickle
-from dataclasses import dataclass
+import sqlite3
+import zlib
+from dataclasses import dataclass, replace as data_replace
+from functools import cached_property
+from collections.abc import MutableSet
+from contextlib import contextmanager
 from pathlib import Path
-from reflink import supported_at
+from hashlib import blake2b
+from typing import TYPE_CHECKING, ContextManager, Iterator, TypeVar
 from datetime import datetime
 from peets.config import Config, Op
-from peets._plugin import Plugin
+from peets.entities import MediaEntity, MediaFileType
+from peets.finder import ScanSnapshot, is_video
+
+if TYPE_CHECKING:
+    from peets._plugin import Plugin
+    from peets.guessit import GuessCache
+
+
+_FINGERPRINT_CHUNK = 64 * 1024
+
+
+def fingerprint(path: Path) -> str:
+    """
+    文件大小加上头、中、尾三段内容的 hash，读取量固定，与文件大小无关
+    """
+    h = blake2b(digest_size=16)
+    with path.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= _FINGERPRINT_CHUNK * 3:
+            h.update(f.read())
+        else:
+            for offset in (0, size // 2, size - _FINGERPRINT_CHUNK):
+                h.update(os.pread(f.fileno(), _FINGERPRINT_CHUNK, offset))
+    return f"{size}:{h.hexdigest()}"
+
+
+E = TypeVar("E", bound=MediaEntity)
+
+_INSERT_RECORD = (
+    "INSERT INTO record (source, op, dest, date, digest) VALUES (?, ?, ?, ?, ?)"
+)
 
 
 @dataclass
@@ -15,46 +52,374 @@ class Record:
     op: Op
     dest: Path
     date: datetime
+    digest: str | None = None  # 见 peets.transfer.Digest，只有复制的文件才有
+
+
+class RecordStore:
+    """
+    基于 SQLite（WAL）的 Record 存储，每次写入只是一条 insert，启动时不加载历史
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # 每次提交 fsync 一次，提交按 transaction 合并
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._depth = 0
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS record ("
+                "id INTEGER PRIMARY KEY, source TEXT NOT NULL, op TEXT NOT NULL,"
+                " dest TEXT NOT NULL, date TEXT NOT NULL, digest TEXT)"
+            )
+            columns = {r[1] for r in self._conn.execute("PRAGMA table_info(record)")}
+            if "digest" not in columns:
+                self._conn.execute("ALTER TABLE record ADD COLUMN digest TEXT")
+            for column in ("source", "dest", "date"):
+                self._conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS record_{column} ON record({column})"
+                )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprint ("
+                "fp TEXT NOT NULL, dest TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS fingerprint_fp ON fingerprint(fp)"
+            )
+            # 处理完成时的完整 entity，dest 为不含后缀的命名路径
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entity ("
+                "dest TEXT PRIMARY KEY, source TEXT, data BLOB NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS entity_source ON entity(source)"
+            )
+
+    @staticmethod
+    def _to_row(r: Record) -> tuple[str, str, str, str, str | None]:
+        return (str(r.source), r.op.name, str(r.dest), r.date.isoformat(), r.digest)
+
+    @staticmethod
+    def _from_row(row: tuple[str, str, str, str, str | None]) -> Record:
+        source, op, dest, date, digest = row
+        return Record(
+            Path(source), Op[op], Path(dest), datetime.fromisoformat(date), digest
+        )
+
+    def add(self, record: Record):
+        self._conn.execute(
+            _INSERT_RECORD,
+            self._to_row(record),
+        )
+        if not self._depth:
+            self._conn.commit()
+
+    def add_fingerprint(self, fp: str, dest: Path):
+        self._conn.execute("INSERT INTO fingerprint VALUES (?, ?)", (fp, str(dest)))
+        if not self._depth:
+            self._conn.commit()
+
+    @property
+    def version(self) -> int:
+        """
+        PRAGMA user_version，记录已完成的一次性升级
+        """
+        return self._conn.execute("PRAGMA user_version").fetchone()[0]
+
+    @version.setter
+    def version(self, value: int):
+        with self._conn:
+            self._conn.execute(f"PRAGMA user_version = {int(value)}")
+
+    def find_fingerprint(self, fp: str) -> Path | None:
+        row = self._conn.execute(
+            "SELECT dest FROM fingerprint WHERE fp = ? LIMIT 1", (fp,)
+        ).fetchone()
+        return Path(row[0]) if row else None
+
+    def put_entity(self, dest: Path, source: Path | None, data: bytes):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO entity VALUES (?, ?, ?)",
+            (str(dest), source and str(source), data),
+        )
+        if not self._depth:
+            self._conn.commit()
+
+    def get_entity(self, dest: Path) -> bytes | None:
+        row = self._conn.execute(
+            "SELECT data FROM entity WHERE dest = ?", (str(dest),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def entity_by_source(self, source: Path) -> bytes | None:
+        row = self._conn.execute(
+            "SELECT data FROM entity WHERE source = ? LIMIT 1", (str(source),)
+        ).fetchone()
+        return row[0] if row else None
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        期间的写入在最外层结束时一起提交，出现异常则全部回滚，可以嵌套
+        """
+        self._depth += 1
+        try:
+            yield
+        except BaseException:
+            if self._depth == 1:
+                self._conn.rollback()
+            raise
+        else:
+            if self._depth == 1:
+                self._conn.commit()
+        finally:
+            self._depth -= 1
+
+    def migrate(self, pickle_path: Path):
+        """
+        导入旧的 .record.pickle，完成后重命名为 .bak
+        """
+        with pickle_path.open("rb") as f:
+            records: list[Record] = pickle.load(f)
+        with self._conn:
+            self._conn.executemany(
+                _INSERT_RECORD,
+                map(self._to_row, records),
+            )
+        pickle_path.rename(pickle_path.with_name(f"{pickle_path.name}.bak"))
+        print(f"migrated {len(records)} records from {pickle_path}")
+
+    def _select(self, where: str = "", params: tuple = ()) -> Iterator[Record]:
+        rows = self._conn.execute(
+            f"SELECT source, op, dest, date, digest FROM record {where} ORDER BY id",
+            params,
+        )
+        return map(self._from_row, rows)
+
+    def __iter__(self) -> Iterator[Record]:
+        return self._select()
+
+    def has_source(self, source: Path) -> bool:
+        return bool(
+            self._conn.execute(
+                "SELECT 1 FROM record WHERE source = ? LIMIT 1", (str(source),)
+            ).fetchone()
+        )
+
+    def by_dest(self, dest: Path) -> list[Record]:
+        """
+        dest 本身及其目录下的记录
+        """
+        # 用范围查询代替 LIKE 以使用索引，"0" 是 "/" 的下一个字符
+        prefix = str(dest).rstrip("/")
+        return list(
+            self._select(
+                "WHERE dest = ? OR (dest >= ? AND dest < ?)",
+                (prefix, f"{prefix}/", f"{prefix}0"),
+            )
+        )
+
+    def by_date(self, start: datetime, end: datetime) -> list[Record]:
+        return list(
+            self._select(
+                "WHERE date >= ? AND date < ?", (start.isoformat(), end.isoformat())
+            )
+        )
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM record").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+class ProcessedSet(MutableSet):
+    """
+    本次运行处理过的路径，以及历史记录中的 source
+
+    历史记录不会被加载到内存，查询时使用 source 索引
+    """
+
+    def __init__(self, records: RecordStore) -> None:
+        self._records = records
+        self._paths: set = set()
+
+    def __contains__(self, path: object) -> bool:
+        return path in self._paths or (
+            isinstance(path, Path) and self._records.has_source(path.absolute())
+        )
+
+    def __iter__(self) -> Iterator:
+        return iter(self._paths)
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def add(self, path):
+        self._paths.add(path)
+
+    def discard(self, path):
+        self._paths.discard(path)
+
+
+# records.version 达到该值时已为历史记录建立 fingerprint 索引
+_FINGERPRINT_VERSION = 1
+
+
+def _rebuild_fingerprints(path: Path, records: RecordStore):
+    with records.transaction():
+        for r in list(records):
+            dest = path.joinpath(r.dest)
+            if (
+                is_video(dest)
+                and dest.is_file()
+                and not records.find_fingerprint(fp := fingerprint(dest))
+            ):
+                records.add_fingerprint(fp, r.dest)
 
 
 class Library:
+    """
+    构造时不做任何 IO，records、config、manager 等在首次使用时才初始化
+    """
+
     def __init__(self, path: Path):
         self.path = path
-        path.mkdir(parents=True, exist_ok=True)
-        self._load_record()
-
-        self._load_config()
-        if self.config.op == Op.Reflink:
-            if not supported_at(self.path):
-                self.config.op = Op.Copy
-                print("lib_path {path} is not supported reflink. fallback to copy.")
-
-        self._init_plugin()
-
-    def _load_record(self):
-        record_path = self.path.joinpath(".record.pickle")
-        self.record_list = []
-        if record_path.exists():
-            with record_path.open("rb") as f:
-                self.record_list = pickle.load(f)
-
-    def _load_config(self):
-        self.config = Config()
+
+    @cached_property
+    def records(self) -> RecordStore:
+        self.path.mkdir(parents=True, exist_ok=True)
+        records = RecordStore(self.path.joinpath(".record.db"))
+        legacy = self.path.joinpath(".record.pickle")
+        migrated = legacy.exists()
+        if migrated:
+            records.migrate(legacy)
+        # 引入 fingerprint 之前的 library 或刚迁移的记录，只补充一次索引。
+        # 不能以 fingerprint 表是否为空判断，没有视频的 library 每次启动都会遍历记录
+        if migrated or records.version < _FINGERPRINT_VERSION:
+            _rebuild_fingerprints(self.path, records)
+            records.version = _FINGERPRINT_VERSION
+        return records
+
+    def is_processed(self, path: Path) -> bool:
+        return self.records.has_source(path.absolute())
+
+    def records_for(self, dest_dir: Path) -> list[Record]:
+        """
+        dest_dir 可以是绝对路径或相对于 library 的路径
+        """
+        if dest_dir.is_absolute():
+            dest_dir = dest_dir.relative_to(self.path)
+        return self.records.by_dest(dest_dir)
+
+    def records_between(self, start: datetime, end: datetime) -> list[Record]:
+        return self.records.by_date(start, end)
+
+    def processed(self) -> ProcessedSet:
+        return ProcessedSet(self.records)
+
+    @property
+    def record_list(self) -> list[Record]:
+        """
+        全部的历史记录，需要遍历整个存储
+        """
+        return list(self.records)
+
+    @cached_property
+    def config(self) -> Config:
+        config = Config()
         user_config = Path.home().joinpath(".config/peets/config.yml")
         lib_config = self.path.joinpath(".peets.yml")
-        self.config.merge(user_config)
-        self.config.merge(lib_config)
+        config.merge(user_config)
+        config.merge(lib_config)
+        # reflink 不可用时按源、目标设备逐个文件退回 copy，见 peets.transfer.clone
+        return config
+
+    @cached_property
+    def guess_cache(self) -> GuessCache:
+        from peets.guessit import GuessCache
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        return GuessCache(self.path.joinpath(".guess.db"))
+
+    @cached_property
+    def scan_snapshot(self) -> ScanSnapshot:
+        return ScanSnapshot(self.path.joinpath(".scan.pickle"))
+
+    @cached_property
+    def manager(self) -> Plugin:
+        from peets._plugin import Plugin
 
-    def _init_plugin(self):
-        self.manager = Plugin(self)
+        return Plugin(self)
 
-    def _save_record(self):
-        record_path = self.path.joinpath(".record.pickle")
-        with record_path.open("wb") as f:
-            pickle.dump(self.record_list, f)
+    def transaction(self) -> ContextManager[None]:
+        """
+        一个媒体（或整个 tvshow）的记录作为一个事务提交
 
-    def record(self, source: Path, op: Op, dest: Path):
-        self.record_list.append(
-            Record(source.absolute(), op, dest.relative_to(self.path), datetime.now())
+            with lib.transaction():
+                lib.record(...)
+        """
+        return self.records.transaction()
+
+    def record(self, source: Path, op: Op, dest: Path, digest: str | None = None):
+        relative = dest.relative_to(self.path)
+        with self.transaction():
+            self.records.add(
+                Record(source.absolute(), op, relative, datetime.now(), digest)
+            )
+            if is_video(dest) and dest.is_file():
+                self.records.add_fingerprint(fingerprint(dest), relative)
+
+    def snapshot(self, media: MediaEntity, dest: Path, source: Path | None = None):
+        """
+        保存处理完成的 entity，重新命名、生成 NFO 时无需再次刮削
+
+        dest: entity 在库中不含后缀的命名路径
+        source: 主视频的源路径，用于按 source 查询
+        """
+        data = zlib.compress(pickle.dumps(media, pickle.HIGHEST_PROTOCOL), 1)
+        self.records.put_entity(
+            dest.relative_to(self.path), source and source.absolute(), data
         )
-        self._save_record()
+
+    def entity(self, dest: Path) -> MediaEntity | None:
+        """
+        dest 可以是绝对路径或相对于 library 的路径
+        """
+        if dest.is_absolute():
+            dest = dest.relative_to(self.path)
+        data = self.records.get_entity(dest)
+        return pickle.loads(zlib.decompress(data)) if data else None
+
+    def entity_of(self, source: Path) -> MediaEntity | None:
+        data = self.records.entity_by_source(source.absolute())
+        return pickle.loads(zlib.decompress(data)) if data else None
+
+    def find_duplicate(self, path: Path) -> Path | None:
+        """
+        找出库中内容相同的视频，返回其路径
+        """
+        if not is_video(path) or not path.is_file():
+            return None
+        if dest := self.records.find_fingerprint(fingerprint(path)):
+            return self.path.joinpath(dest)
+        return None
+
+    def check_duplicate(self, media: E) -> E:
+        """
+        主视频已在库中时设置 duplicate
+        """
+        video = next(
+            (p for t, p in media.media_files if t is MediaFileType.VIDEO), None
+        )
+        if video and (dest := self.find_duplicate(video)):
+            print(f"{video} is duplicate of {dest}")
+            return data_replace(media, duplicate=True)
+        return media
+
+    def rebuild_fingerprints(self):
+        """
+        为没有 fingerprint 的历史记录补充索引
+        """
+        _rebuild_fingerprints(self.path, self.records)
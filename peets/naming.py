@@ -1,15 +1,19 @@
 from functools import partial
+import errno
+import os
 import stat
+from dataclasses import replace as data_replace
 from os import chmod
 from pathlib import Path
-from shutil import copy
+from typing import Callable
+from shutil import copytree
 
-from reflink import reflink
 from peets.config import Config, Op
 
 from peets.entities import MediaEntity, MediaFileType
+from peets.fileop import FileOpError, FileOpRun, default_executor
 from peets.library import Library
-
+from peets.transfer import Digest, clone, copy, hardlink, move, verify_digest
 
 
 def _naming(media: MediaEntity, template="{title}({year})") -> str:
@@ -39,41 +43,327 @@ def _media_file(type_: MediaFileType, prefix: str) -> str:
         return type_.name.lower()  # FIXME
 
 
-def _op(src: Path, dst: Path, op: Op):
+def _op(src: Path, dst: Path, op: Op, checksum: bool = False, verify: bool = False):
+    """
+    checksum: 复制时同时计算 digest，reflink/hardlink/rename 没有实际复制，不计算
+    verify: 重新读取 dst 校验 digest，隐含 checksum
+    """
+    digest = Digest() if checksum or verify else None
+    method = None
+    moved = None
     if op == Op.Reflink:
-        reflink(str(src), str(dst))
+        # 按设备组合退回 copy，记录实际使用的 op
+        op, method = clone(src, dst, digest)
     elif op == Op.Copy:
-        copy(src, dst)
+        method = copy(src, dst, digest)
+    elif op == Op.Move:
+        # 跨设备时 move 已经完整校验过
+        moved = move(src, dst)
+    elif op == Op.Hardlink:
+        # 记录实际使用的 op
+        op, method = hardlink(src, dst, digest)
     else:
         raise ValueError(f"{op=} is not support yet.")
+    if method:
+        # 实际复制时报告使用的方式，如退回 readinto 时可能是设备不支持
+        print(f"{op.name.lower()} {src} -> {dst} via {method}")
+
+    value = digest.hexdigest() if digest and digest.hexdigest() else None
+    if value and verify:
+        verify_digest(dst, value)
+    if moved and digest:
+        value = moved
+    return (src, op, dst, value)
+
+
+def _link_op(
+    src: Path, moved: Path, dst: Path, checksum: bool = False, verify: bool = False
+):
+    """
+    多集文件的多个 episode 共用一个源文件，move 之后其余的目标从 moved 链接，
+    记录中仍然是原来的源文件
+    """
+    _, op, _, digest = _op(moved, dst, Op.Hardlink, checksum, verify)
+    return (src, op, dst, digest)
+
+
+def _steps(steps: list[tuple[Callable, tuple]]) -> list:
+    results: list = []
+    for fn, args in steps:
+        try:
+            results.append(fn(*args))
+        except Exception as e:
+            # 已完成的步骤仍然需要记录
+            raise FileOpError(str(e), [e], results) from e
+    return results
+
+
+def _disc_dirs(src: Path) -> list[Path]:
+    return [d for d in src.iterdir() if d.is_dir() and not d.name.startswith(".")]
+
 
+def _disc_op(src: Path, dst: Path, op: Op):
+    """
+    光盘目录，按 Kodi 的约定在 dst 内保留 VIDEO_TS/BDMV 等子目录结构
+    """
+
+    used = set()
+
+    def _copy_file(s: str, d: str):
+        used.add(_op(Path(s), Path(d), op)[1])
+
+    for d in _disc_dirs(src):
+        if op == Op.Move:
+            # 整个子目录一起移动，同一设备上只是一次 rename
+            move(d, dst.joinpath(d.name))
+        else:
+            copytree(d, dst.joinpath(d.name), copy_function=_copy_file)
+    # hardlink/reflink 可能部分退回，记录代价最高的 op
+    if used:
+        op = max(used, key=[Op.Hardlink, Op.Reflink, Op.Copy].index)
     return (src, op, dst)
 
-def do_copy(media: MediaEntity, lib: Library):
+
+def _sidecar_op(src: Path, dst: Path, op: Op, mod: int | None, config: Config):
+    result = _op(src, dst, op, config.checksum, config.verify)
+    # 与主视频文件的权限保持一致
+    if mod:
+        chmod(dst, mod)
+    return result
+
+
+class Batch:
+    """
+    收集一个或多个媒体（如整个 tvshow）的文件操作，交给 FileOpExecutor 统一调度，
+    全部结束后按添加顺序记录
+    """
+
+    def __init__(self) -> None:
+        # (src, dst, [(fn, args)])
+        self._ops: list[tuple[Path, Path, list[tuple[Callable, tuple]]]] = []
+        # src -> 在 _ops 中的位置
+        self._sources: dict[Path, int] = {}
+        self._dests: set[Path] = set()
+        self._snapshots: list[tuple[MediaEntity, Path, Path | None]] = []
+        self._run: FileOpRun | None = None
+
+    def claim(self, dst: Path):
+        """
+        占用目标路径，dst 已在 batch 中或已存在时抛出 FileExistsError，
+        避免两个操作同时写入同一个文件，或者覆盖库中已有的文件。
+        中断的复制留下的是 dst.part、dst.moving，不影响重试时继续
+        """
+        if dst in self._dests or os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(dst))
+        self._dests.add(dst)
+
+    def add(self, src: Path, dst: Path, fn: Callable, *args):
+        """
+        同一个源文件的操作在同一个任务中按添加顺序执行
+        """
+        if src in self._sources:
+            self._ops[self._sources[src]][2].append((fn, args))
+        else:
+            self._sources[src] = len(self._ops)
+            self._ops.append((src, dst, [(fn, args)]))
+
+    def target(self, src: Path) -> Path | None:
+        """
+        src 第一个操作的目标
+        """
+        return self._ops[self._sources[src]][1] if src in self._sources else None
+
+    def snapshot(self, media: MediaEntity, dest: Path, source: Path | None):
+        self._snapshots.append((media, dest, source))
+
+    @property
+    def dests(self) -> set[Path]:
+        return self._dests
+
+    def start(self):
+        """
+        提交给 default_executor，不等待，由 finish 等待结束并记录。
+        提交期间被中断时抛出原来的 KeyboardInterrupt 等，已完成的操作仍由 finish 记录
+        """
+        ops = [(src, dst, _steps, (steps,)) for src, dst, steps in self._ops]
+        self._ops, self._sources = [], {}
+        self._run = default_executor().submit(ops)
+        if self._run.interrupted:
+            raise self._run.interrupted
+
+    def done(self) -> bool:
+        return self._run is None or self._run.done()
+
+    def cancel(self, interrupt: BaseException):
+        if self._run:
+            self._run.cancel(interrupt)
+
+    def finish(self, lib: Library):
+        """
+        记录在一个事务中提交，有操作失败时也先提交成功的操作再抛出，
+        否则文件已经移动到库中却没有记录。不能在 lib.transaction() 中调用
+        """
+        run, self._run = self._run, None
+        snapshots, self._snapshots = self._snapshots, []
+        self._dests = set()
+        if run is None:
+            return
+        error = None
+        try:
+            results = run.result()
+        except FileOpError as e:
+            results, error = e.results, e
+        with lib.transaction():
+            for steps in filter(None, results):
+                for r in steps:
+                    lib.record(*r)
+            if not error:
+                for s in snapshots:
+                    lib.snapshot(*s)
+        if error:
+            # 被中断时记录已完成的操作之后，抛出原来的 KeyboardInterrupt 等
+            cause = error.__cause__
+            if cause is not None and not isinstance(cause, Exception):
+                raise cause
+            raise error
+
+    def run(self, lib: Library):
+        """
+        执行并等待结束，见 start 及 finish
+        """
+        try:
+            self.start()
+        finally:
+            self.finish(lib)
+
+
+class BatchQueue:
+    """
+    跨媒体的文件操作队列。submit 后立即返回，交互处理下一个媒体时文件操作继续进行，
+    来自不同磁盘的导入在 executor 中同时调度。
+
+    sqlite 连接只能在创建它的线程中使用，记录由调用者所在的线程在 commit 中写入，
+    每个 batch 完成后单独提交
+    """
+
+    def __init__(self, lib: Library) -> None:
+        self.lib = lib
+        self._pending: list[Batch] = []
+        # 尚未完成的 batch 的目标，还不存在于磁盘上，Batch.claim 检查不到
+        self._dests: set[Path] = set()
+
+    def submit(self, batch: Batch):
+        if conflict := batch.dests & self._dests:
+            path = str(next(iter(conflict)))
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        self._dests |= batch.dests
+        self._pending.append(batch)
+        batch.start()
+
+    def commit(self, wait: bool = False):
+        """
+        记录已完成的 batch，wait 时等待所有 batch 结束。
+        有 batch 失败时其余已完成的 batch 仍然记录，之后抛出第一个错误；
+        等待期间被中断时其余 batch 不再开始新的操作
+        """
+        error: BaseException | None = None
+        pending = []
+        for batch in self._pending:
+            if not (wait or batch.done()):
+                pending.append(batch)
+                continue
+            dests = set(batch.dests)
+            try:
+                batch.finish(self.lib)
+            except BaseException as e:
+                if not isinstance(e, Exception):
+                    for b in self._pending:
+                        b.cancel(e)
+                error = error or e
+            self._dests -= dests
+        self._pending = pending
+        if error:
+            raise error
+
+    def close(self):
+        self.commit(wait=True)
+
+
+def do_copy(media: MediaEntity, lib: Library, batch: Batch | None = None):
+    """
+    batch 不为 None 时只把操作加入 batch，由调用者执行
+    """
     lib_path = lib.path
     config = lib.config
+    own = batch is None
+    batch = batch or Batch()
 
     # create folder
     naming = _naming(media, template=config.naming_template)
     _tmp = lib_path.joinpath(naming)
     parent = _tmp.parent
     prefix = _tmp.name
-    parent.mkdir(parents=True)
 
     # main video
     mod = None
+    media_files = []
     if main_video_path := media.main_video():
-        new_path = parent.joinpath(f"{prefix}{main_video_path.suffix}")
-        lib.record(*_op(main_video_path, new_path, config.op))
-        mod = stat.S_IMODE(new_path.stat().st_mode)
+        if main_video_path.is_dir():
+            for d in _disc_dirs(main_video_path):
+                batch.claim(parent.joinpath(d.name))
+            batch.add(
+                main_video_path, parent, _disc_op, main_video_path, parent, config.op
+            )
+            media_files.append((MediaFileType.VIDEO, parent))
+        else:
+            new_path = parent.joinpath(f"{prefix}{main_video_path.suffix}")
+            batch.claim(new_path)
+            if config.op == Op.Move and (moved := batch.target(main_video_path)):
+                # 多集文件，源文件已由前一个 episode 移动
+                batch.add(
+                    main_video_path,
+                    new_path,
+                    _link_op,
+                    main_video_path,
+                    moved,
+                    new_path,
+                    config.checksum,
+                    config.verify,
+                )
+            else:
+                batch.add(
+                    main_video_path,
+                    new_path,
+                    _op,
+                    main_video_path,
+                    new_path,
+                    config.op,
+                    config.checksum,
+                    config.verify,
+                )
+            # 与主视频并行，取源文件的权限（复制时主视频也保留源文件的权限）
+            mod = stat.S_IMODE(main_video_path.stat().st_mode)
+            media_files.append((MediaFileType.VIDEO, new_path))
     # other media file
 
     simple = "simple" == config.media_file_naming_style
     media_file_selected = _media_file_simple if simple else partial(_media_file, prefix=prefix)
+    # 附属文件与主视频使用相同的 op，但 hardlink 时改用 reflink（不支持时复制），
+    # 库中的 NFO 等修改后不会影响到做种的源文件
+    sidecar = Op.Reflink if config.op == Op.Hardlink else config.op
     for t, p in media.media_files:
         if p is not main_video_path:
             n = parent.joinpath(f"{media_file_selected(t)}{p.suffix}")
-            lib.record(*_op(p, n, Op.Copy))  # TODO performance matter
-            # 与主视频文件的权限保持一致
-            if mod:
-                chmod(n, mod)
+            batch.claim(n)
+            if sidecar == Op.Move and (moved := batch.target(p)):
+                batch.add(p, n, _link_op, p, moved, n, config.checksum, config.verify)
+            else:
+                batch.add(p, n, _sidecar_op, p, n, sidecar, mod, config)
+            media_files.append((t, n))
+
+    # 所有目标都没有冲突之后才创建目录，重试时目录已存在
+    parent.mkdir(parents=True, exist_ok=True)
+    # 快照中的 media_files 指向库中的文件
+    batch.snapshot(data_replace(media, media_files=media_files), _tmp, main_video_path)
+    if own:
+        batch.run(lib)
@@ -0,0 +1,495 @@
+"""
+单个文件（或目录）的传输：move、copy 等
+"""
+import errno
+import json
+import mmap
+import os
+import shutil
+from hashlib import blake2b
+from pathlib import Path
+from typing import Callable, Literal, NamedTuple
+
+from reflink import ReflinkImpossibleError, reflink
+
+from peets.config import Op
+
+# os.link 失败时可以退回 reflink/copy 的错误：跨设备、文件系统不支持、链接数上限
+_LINK_FALLBACK = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP}
+# copy_file_range/sendfile 不可用时的错误，退回下一种方式
+# macOS 的 sendfile 只支持 socket，返回 ENOTSOCK
+_COPY_FALLBACK = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EINVAL,
+    errno.ENOTSOCK,
+}
+# 每次系统调用的最大长度，过大时单次调用无法被中断
+_COPY_CHUNK = 1 << 30
+_BUFFER_SIZE = 8 << 20
+# 超过该大小的文件按 _STREAM_CHUNK 分块复制并丢弃 page cache
+_STREAM_THRESHOLD = 64 << 20
+_STREAM_CHUNK = 64 << 20
+# checkpoint 的 hash 只取每块末尾的 _SAMPLE_SIZE 字节
+_SAMPLE_SIZE = 64 * 1024
+
+# 只有这些错误说明设备不支持，缓存下来，其余错误（如 EINVAL）可能只与文件有关
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK}
+
+CopyMethod = Literal["copy_file_range", "sendfile", "readinto", "copyfile"]
+
+# (源 st_dev, 目标 st_dev) -> 已确认不可用的方式
+_unsupported: dict[tuple[int, int], set[str]] = {}
+
+
+def _devices(src: Path | str, dst: Path | str) -> tuple[int, int]:
+    dst = Path(dst)
+    return os.stat(src).st_dev, os.stat(dst if dst.exists() else dst.parent).st_dev
+
+
+def supported(devices: tuple[int, int], method: str) -> bool:
+    return method not in _unsupported.get(devices, ())
+
+
+def _mark_unsupported(devices: tuple[int, int], method: str):
+    _unsupported.setdefault(devices, set()).add(method)
+
+
+def _fdatasync(fd: int):
+    # macOS 没有 fdatasync
+    getattr(os, "fdatasync", os.fsync)(fd)
+
+
+def _fadvise(fd: int, offset: int, length: int, advice: str):
+    """
+    advice: POSIX_FADV_* 的名字，macOS、Windows 没有 posix_fadvise 时跳过
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+
+
+class Digest:
+    """
+    按 _STREAM_CHUNK 分块链接的 BLAKE2，每块的 hash 以前一块的结果作为前缀。
+    状态只是一个 hex 字符串，可以保存到 checkpoint 中，中断后继续计算。
+    不超过一块的文件与 blake2b(content, digest_size=32) 相同
+    """
+
+    def __init__(self, state: str = "") -> None:
+        self.state = state
+        self._h = blake2b(digest_size=32)
+
+    def begin(self):
+        self._h = blake2b(bytes.fromhex(self.state), digest_size=32)
+
+    def update(self, data: bytes | memoryview):
+        self._h.update(data)
+
+    def end(self):
+        self.state = self._h.hexdigest()
+
+    def hexdigest(self) -> str:
+        return self.state
+
+
+def file_digest(path: Path | str, drop_cache: bool = False) -> str:
+    """
+    与复制时计算的 Digest 相同
+
+    drop_cache: 先写回并丢弃 page cache，确保读到的是磁盘上的内容
+    """
+    digest = Digest()
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        if drop_cache:
+            _fdatasync(fd)
+            _fadvise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+        size = os.fstat(fd).st_size
+        # 空文件也计算一块
+        for start in range(0, max(size, 1), _STREAM_CHUNK):
+            digest.begin()
+            remaining = _STREAM_CHUNK
+            while remaining and (data := f.read(min(_BUFFER_SIZE, remaining))):
+                digest.update(data)
+                remaining -= len(data)
+            digest.end()
+        if drop_cache:
+            _fadvise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+    return digest.hexdigest()
+
+
+def verify_digest(path: Path | str, expected: str):
+    if file_digest(path, drop_cache=True) != expected:
+        raise OSError(errno.EIO, "digest mismatch after copy", str(path))
+
+
+def same_device(src: Path, dst: Path) -> bool:
+    """
+    dst 不存在时比较其父目录
+    """
+    dst_stat = os.stat(dst if dst.exists() else dst.parent)
+    return os.stat(src).st_dev == dst_stat.st_dev
+
+
+def _remove(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+def move(src: Path, dst: Path) -> str | None:
+    """
+    同一设备上直接 rename；跨设备时先复制到 dst.moving，完整校验后再改名为 dst 并删除源文件。
+    dst 已存在时抛出 FileExistsError，不会替换库中已有的文件；
+    失败时只删除 dst.moving，源文件保持不变
+
+    跨设备移动文件时返回复制时计算的 digest，rename 和目录返回 None
+    """
+    if os.path.lexists(dst):
+        # rename/replace 会静默覆盖已存在的文件，目录也不能合并后再回滚
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(dst))
+    if same_device(src, dst):
+        try:
+            os.rename(src, dst)
+            return None
+        except OSError as e:
+            # 同一设备的不同挂载点（如 bind mount）之间也不能 rename
+            if e.errno != errno.EXDEV:
+                raise
+    tmp = dst.with_name(f"{dst.name}.moving")
+    # 复制时计算的 digest，删除源文件前与重新读取的目标文件完整比较
+    digests: dict[str, str] = {}
+
+    def _copy_digest(s: Path | str, d: Path | str):
+        digest = Digest()
+        _copy2(s, d, digest)
+        digests[str(d)] = digest.hexdigest()
+
+    try:
+        if src.is_dir():
+            # 上次中断留下的 tmp 继续使用，大文件可以从 checkpoint 继续
+            shutil.copytree(src, tmp, copy_function=_copy_digest, dirs_exist_ok=True)
+        else:
+            _copy_digest(src, tmp)
+        for d, expected in digests.items():
+            verify_digest(d, expected)
+    except Exception:
+        # 被中断（KeyboardInterrupt 等）时保留 tmp，重试时继续
+        _remove(tmp)
+        raise
+    os.replace(tmp, dst)
+    _remove(src)
+    # 目录的 digest 按其中的文件保存
+    return digests.get(str(tmp))
+
+
+def hardlink(
+    src: Path, dst: Path, digest: Digest | None = None
+) -> tuple[Op, CopyMethod | None]:
+    """
+    硬链接，失败时逐个文件退回 reflink，再退回 copy，
+    返回实际使用的 op 及 copy 的方式（没有复制时为 None）
+    """
+    devices = _devices(src, dst)
+    if supported(devices, "link"):
+        try:
+            os.link(src, dst)
+            return Op.Hardlink, None
+        except OSError as e:
+            if e.errno not in _LINK_FALLBACK:
+                raise
+            if e.errno in _UNSUPPORTED:
+                _mark_unsupported(devices, "link")
+    return clone(src, dst, digest)
+
+
+def clone(
+    src: Path, dst: Path, digest: Digest | None = None
+) -> tuple[Op, CopyMethod | None]:
+    """
+    reflink，当前设备组合不支持时逐个文件退回 copy，
+    返回实际使用的 op 及 copy 的方式（没有复制时为 None）
+
+    digest: 只在退回 copy 时计算
+    """
+    devices = _devices(src, dst)
+    if supported(devices, "reflink"):
+        try:
+            reflink(str(src), str(dst))
+            return Op.Reflink, None
+        except (ReflinkImpossibleError, NotImplementedError):
+            _mark_unsupported(devices, "reflink")
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            _mark_unsupported(devices, "reflink")
+    return Op.Copy, copy(src, dst, digest)
+
+
+def _copy_file_range(fin: int, fout: int, offset: int, end: int) -> int:
+    while offset < end:
+        count = min(end - offset, _COPY_CHUNK)
+        n = os.copy_file_range(fin, fout, count, offset, offset)
+        if n == 0:
+            break
+        offset += n
+    return offset
+
+
+def _sendfile(fin: int, fout: int, offset: int, end: int) -> int:
+    os.lseek(fout, offset, os.SEEK_SET)
+    while offset < end:
+        n = os.sendfile(fout, fin, offset, min(end - offset, _COPY_CHUNK))
+        if n == 0:
+            break
+        offset += n
+    return offset
+
+
+def _readinto(
+    fin: int, fout: int, offset: int, end: int, digest: Digest | None = None
+) -> int:
+    # 匿名 mmap 按页对齐
+    with mmap.mmap(-1, _BUFFER_SIZE) as buf:
+        view = memoryview(buf)
+        try:
+            while offset < end:
+                n = os.preadv(fin, [view[: min(end - offset, _BUFFER_SIZE)]], offset)
+                if n == 0:
+                    break
+                if digest:
+                    digest.update(view[:n])
+                written = 0
+                while written < n:
+                    written += os.pwrite(fout, view[written:n], offset + written)
+                offset += n
+        finally:
+            view.release()
+    return offset
+
+
+# copy_file_range 只有 Linux 有，跳过当前平台没有的方式
+_METHODS: list[tuple[CopyMethod, Callable[[int, int, int, int], int]]] = [
+    (method, fn)
+    for method, fn in (
+        ("copy_file_range", _copy_file_range),
+        ("sendfile", _sendfile),
+    )
+    if hasattr(os, method)
+]
+# _readinto 需要 preadv/pwrite，没有时（如 Windows）整个文件交给 shutil.copyfile
+_READINTO = hasattr(os, "preadv") and hasattr(os, "pwrite")
+
+
+def _copy_range(
+    fin: int,
+    fout: int,
+    offset: int,
+    end: int,
+    devices: tuple[int, int],
+    digest: Digest | None = None,
+) -> tuple[int, CopyMethod]:
+    if digest:
+        # 计算 digest 需要经过用户态，读一次同时完成复制和计算
+        return _readinto(fin, fout, offset, end, digest), "readinto"
+    for method, fn in _METHODS:
+        if not supported(devices, method):
+            continue
+        try:
+            offset = fn(fin, fout, offset, end)
+        except OSError as e:
+            # fn 抛出异常时其进度丢失，下一种方式从原来的 offset 重新开始，
+            # 都是按位置写入，已写入的部分被覆盖为相同的内容
+            if e.errno not in _COPY_FALLBACK:
+                raise
+            if e.errno in _UNSUPPORTED:
+                _mark_unsupported(devices, method)
+            continue
+        if offset >= end:
+            return offset, method
+    return _readinto(fin, fout, offset, end), "readinto"
+
+
+def _preallocate(fout: int, size: int):
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fout, 0, size)
+    except OSError as e:
+        # NFS 等不支持时跳过
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+
+
+def _drop_cache(fin: int, fout: int, start: int, end: int):
+    # 脏页不能被丢弃，调用前需要 fdatasync
+    _fadvise(fin, start, end - start, "POSIX_FADV_DONTNEED")
+    _fadvise(fout, start, end - start, "POSIX_FADV_DONTNEED")
+
+
+class Checkpoint(NamedTuple):
+    source: str
+    size: int
+    mtime: int
+    chunk: int
+    # 之前的复制是否计算了 digest
+    checksum: bool
+    offset: int
+    hash: str
+    digest: str
+
+
+def _chain(prev: str, data: bytes) -> str:
+    h = blake2b(bytes.fromhex(prev), digest_size=32)
+    h.update(data)
+    return h.hexdigest()
+
+
+def _sample(fd: int, start: int, end: int) -> bytes:
+    """
+    块末尾的一小段，用于校验 .part 中已复制的部分，读取量很小
+    """
+    n = min(_SAMPLE_SIZE, end - start)
+    return os.pread(fd, n, end - n)
+
+
+def _resume(fout: int, checkpoint: Path, expected: Checkpoint) -> Checkpoint:
+    """
+    checkpoint 与源文件一致，且 .part 中已复制的部分未被修改时，返回保存的 checkpoint，
+    否则返回 expected（从头开始）
+    """
+    try:
+        saved = Checkpoint(**json.loads(checkpoint.read_text()))
+    except (OSError, ValueError, TypeError):
+        return expected
+    if saved[:5] != expected[:5] or os.fstat(fout).st_size < saved.offset:
+        return expected
+    sampled = ""
+    for start in range(0, saved.offset, saved.chunk):
+        end = min(start + saved.chunk, saved.offset)
+        sampled = _chain(sampled, _sample(fout, start, end))
+    return saved if sampled == saved.hash else expected
+
+
+def _save_checkpoint(path: Path, checkpoint: Checkpoint):
+    tmp = path.with_name(f"{path.name}.tmp")
+    tmp.write_text(json.dumps(checkpoint._asdict()))
+    tmp.replace(path)
+
+
+def _stream(fin: int, src: Path, dst: Path, digest: Digest | None) -> CopyMethod:
+    """
+    大文件写入 dst.part，每块完成后记录 checkpoint，
+    中断后对同一 (src, dst) 重试时从最后的 checkpoint 继续
+    """
+    st = os.fstat(fin)
+    size = st.st_size
+    part = dst.with_name(f"{dst.name}.part")
+    checkpoint = dst.with_name(f"{dst.name}.part.ckpt")
+    ckpt = Checkpoint(
+        source=str(src.absolute()),
+        size=size,
+        mtime=st.st_mtime_ns,
+        chunk=_STREAM_CHUNK,
+        checksum=digest is not None,
+        offset=0,
+        hash="",
+        digest="",
+    )
+    method: CopyMethod = "copy_file_range"
+    fout = os.open(part, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        devices = (st.st_dev, os.fstat(fout).st_dev)
+        resumed = _resume(fout, checkpoint, ckpt)
+        offset, sampled = resumed.offset, resumed.hash
+        if offset:
+            print(f"resume {src} from {offset}/{size}")
+            if digest:
+                digest.state = resumed.digest
+        else:
+            os.ftruncate(fout, 0)
+        _preallocate(fout, size)
+        _fadvise(fin, offset, 0, "POSIX_FADV_SEQUENTIAL")
+        while offset < size:
+            start, end = offset, min(offset + _STREAM_CHUNK, size)
+            if digest:
+                digest.begin()
+            offset, method = _copy_range(fin, fout, start, end, devices, digest)
+            if digest:
+                digest.end()
+            _fdatasync(fout)
+            sampled = _chain(sampled, _sample(fout, start, offset))
+            _drop_cache(fin, fout, start, offset)
+            if offset < end:
+                # 源文件在复制期间变短
+                os.ftruncate(fout, offset)
+                break
+            if offset < size:
+                # 数据写回后才记录
+                _save_checkpoint(
+                    checkpoint,
+                    ckpt._replace(
+                        offset=offset,
+                        hash=sampled,
+                        digest=digest.hexdigest() if digest else "",
+                    ),
+                )
+    finally:
+        os.close(fout)
+    part.replace(dst)
+    checkpoint.unlink(missing_ok=True)
+    return method
+
+
+def copy_file(
+    src: Path | str, dst: Path | str, digest: Digest | None = None
+) -> CopyMethod:
+    """
+    只复制内容，依次尝试 copy_file_range（NFS 4.2 可以在服务端复制）、sendfile、
+    用户态的大块读写，返回最终完成复制的方式
+
+    大文件预先分配空间，按块复制，每块完成后从 page cache 中丢弃源和目标，
+    避免挤出其他服务的缓存；中断后可以继续，见 _stream
+
+    digest: 复制的同时计算内容的 Digest，只读取一次源文件
+    """
+    if not _READINTO:
+        shutil.copyfile(src, dst)
+        if digest:
+            digest.state = file_digest(dst)
+        return "copyfile"
+    with open(src, "rb") as fsrc:
+        fin = fsrc.fileno()
+        size = os.fstat(fin).st_size
+        if size >= _STREAM_THRESHOLD:
+            return _stream(fin, Path(src), Path(dst), digest)
+        with open(dst, "wb") as fdst:
+            fout = fdst.fileno()
+            devices = (os.fstat(fin).st_dev, os.fstat(fout).st_dev)
+            if digest:
+                digest.begin()
+            method = _copy_range(fin, fout, 0, size, devices, digest)[1]
+            if digest:
+                digest.end()
+            return method
+
+
+def copy(
+    src: Path | str, dst: Path | str, digest: Digest | None = None
+) -> CopyMethod:
+    """
+    与 shutil.copy 相同，复制内容及权限
+    """
+    method = copy_file(src, dst, digest)
+    shutil.copymode(src, dst)
+    return method
+
+
+def _copy2(
+    src: Path | str, dst: Path | str, digest: Digest | None = None
+) -> CopyMethod:
+    method = copy_file(src, dst, digest)
+    shutil.copystat(src, dst)
+    return method
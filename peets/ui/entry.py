@@ -23,12 +23,17 @@ from peets.util.type_utils import check_iterable_type, is_assignable
 
 
 
-def interact(media: MediaEntity, lib: Library) -> Action:
+def interact(
+    media: MediaEntity, lib: Library, queue: naming.BatchQueue | None = None
+) -> Action:
+    """
+    queue: 文件操作提交到 queue 后立即返回，不等待结束
+    """
     ui = lib.manager.get_ui(media)
     ops = ui.ops() + [
         (
                 "Process",
-                partial(_do_process, lib=lib),
+                partial(_do_process, lib=lib, queue=queue),
             ),
             ("Skip", Action.NEXT),
         ]
@@ -40,7 +45,20 @@ def interact(media: MediaEntity, lib: Library) -> Action:
         return Action.QUIT
 
 
-def _do_process(media: MediaEntity, lib: Library, belong_to: EntityCollection | None = None):
+def _do_process(
+    media: MediaEntity,
+    lib: Library,
+    belong_to: EntityCollection | None = None,
+    batch: naming.Batch | None = None,
+    queue: naming.BatchQueue | None = None,
+):
+    # 内容相同的视频已在库中，不再复制。tvshow 按 episode 分别检查
+    if not isinstance(media, EntityCollection):
+        media = lib.check_duplicate(media)
+    if media.duplicate:
+        print(f"Skip: {media.title} is duplicate.")
+        return Action.NEXT
+
     # fetch online media file
     parsed: list[tuple[MediaFileType, Path]] = [
         (t, _make_sure_media_file(t, uri))
@@ -56,11 +74,17 @@ def _do_process(media: MediaEntity, lib: Library, belong_to: EntityCollection |
 
         parsed.append((MediaFileType.NFO, Path(f.name)))
     media = data_replace(media, media_files=media.media_files + parsed)
-    naming.do_copy(media, lib)
-
+    # tvshow 与其所有 episode 的文件操作一起调度，记录在 Batch.run 中一起提交
+    own = batch is None
+    batch = batch or naming.Batch()
+    naming.do_copy(media, lib, batch)
     if isinstance(media, EntityCollection):
         for e in media:
-            _do_process(e, lib, media)
+            _do_process(e, lib, media, batch)
+    if own and queue:
+        queue.submit(batch)
+    elif own:
+        batch.run(lib)
 
     return Action.NEXT
 
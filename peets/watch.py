@@ -0,0 +1,168 @@
+"""
+基于 Linux inotify 监听目录，文件写入完成后才返回
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import Iterator
+
+from peets.finder import is_ignored, is_video, scan_dir
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct("iIII")
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+
+class Inotify:
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+        return wd
+
+    def read(self) -> Iterator[tuple[int, int, str]]:
+        """
+        yield (wd, mask, name)
+        """
+        buf = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset : offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    递归监听 roots，视频文件 close-write 或 move-in 后，
+    在 settle 秒内没有新的事件且大小不变，才认为写入完成
+    """
+
+    def __init__(self, *roots: Path, settle: float = 5.0) -> None:
+        self.settle = settle
+        self._roots = roots
+        self._inotify = Inotify()
+        self._wds: dict[int, Path] = {}
+        # path -> (deadline, size)
+        self._pending: dict[Path, tuple[float, int]] = {}
+        for root in roots:
+            self._add_tree(root, initial=True)
+
+    def _add_tree(self, dir_: Path, initial: bool = False):
+        try:
+            wd = self._inotify.add_watch(dir_, _WATCH_MASK | IN_ONLYDIR)
+        except OSError as e:
+            print(f"can't watch {dir_}: {e}")
+            return
+        self._wds[wd] = dir_
+        files, dirs = scan_dir(str(dir_))
+        if not initial:
+            # 整个目录被移入，目录内已有的文件不会再产生事件
+            for f in files:
+                self._touch(Path(f.path))
+        for d in dirs:
+            self._add_tree(Path(d.path), initial)
+
+    def _touch(self, path: Path):
+        if not is_video(path):
+            return
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        self._pending[path] = (time.monotonic() + self.settle, size)
+
+    def _handle(self):
+        for wd, mask, name in self._inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                # 丢失的事件无法恢复，重新扫描所有文件，已处理的由调用者忽略
+                print("inotify queue overflow, rescan all targets.")
+                for root in self._roots:
+                    self._add_tree(root)
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                self._wds.pop(wd, None)
+                continue
+            if not (parent := self._wds.get(wd)) or is_ignored(name):
+                continue
+            path = parent.joinpath(name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._touch(path)
+
+    def _ready(self) -> list[Path]:
+        now = time.monotonic()
+        ready = []
+        for path, (deadline, size) in list(self._pending.items()):
+            if deadline > now:
+                continue
+            del self._pending[path]
+            try:
+                current = path.stat().st_size
+            except OSError:
+                continue
+            if current == size:
+                ready.append(path)
+            else:
+                # 仍在写入
+                self._pending[path] = (now + self.settle, current)
+        return sorted(ready)
+
+    def __iter__(self) -> Iterator[Path]:
+        while True:
+            timeout = None
+            if self._pending:
+                deadline = min(d for d, _ in self._pending.values())
+                timeout = max(0.0, deadline - time.monotonic())
+            # 没有待定文件时无限阻塞，空闲时不占用 CPU
+            readable, _, _ = select.select([self._inotify], [], [], timeout)
+            if readable:
+                self._handle()
+            yield from self._ready()
+
+    def close(self):
+        self._inotify.close()
+
+
+def watch(*roots: Path, settle: float = 5.0) -> Iterator[Path]:
+    """
+    持续 yield roots 中写入完成的视频文件
+    """
+    watcher = Watcher(*roots, settle=settle)
+    try:
+        yield from watcher
+    finally:
+        watcher.close()
@@ -0,0 +1,137 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from peets.fileop import FileOpError, FileOpExecutor, position
+
+
+def test_run_order(tmp_path):
+    executor = FileOpExecutor(workers=4)
+
+    def op(i):
+        time.sleep(0.01 * (5 - i))
+        return i
+
+    ops = [(tmp_path, tmp_path, op, (i,)) for i in range(5)]
+    assert executor.run(ops) == list(range(5))
+    executor.shutdown()
+
+
+def test_run_per_device(tmp_path, monkeypatch):
+    monkeypatch.setattr("peets.fileop.rotational", lambda dev: False)
+    executor = FileOpExecutor(workers=8, per_device=2)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def op():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    # 不存在的路径取父目录所在的设备
+    executor.run([(tmp_path, tmp_path.joinpath("a", "b"), op, ()) for _ in range(8)])
+    assert max(peak) == 2
+    executor.shutdown()
+
+
+def test_run_errors(tmp_path):
+    executor = FileOpExecutor()
+
+    def op(i):
+        if i % 2:
+            raise OSError(i)
+        return i
+
+    with pytest.raises(FileOpError) as e:
+        executor.run([(tmp_path, tmp_path, op, (i,)) for i in range(4)])
+    assert len(e.value.errors) == 2
+    assert e.value.results == [0, None, 2, None]
+    executor.shutdown()
+
+
+def test_run_interrupt(tmp_path, monkeypatch):
+    monkeypatch.setattr("peets.fileop.rotational", lambda dev: True)
+    executor = FileOpExecutor(workers=2)
+    calls = []
+
+    def op(i):
+        calls.append(i)
+        if i == 0:
+            # 模拟等待期间按下 Ctrl-C
+            time.sleep(0.05)
+            os.kill(os.getpid(), signal.SIGINT)
+            time.sleep(0.05)
+        return i
+
+    with pytest.raises(FileOpError) as e:
+        executor.run([(tmp_path, tmp_path, op, (i,)) for i in range(4)])
+    assert isinstance(e.value.__cause__, KeyboardInterrupt)
+    # 正在进行的操作完成并返回，之后的操作不再执行
+    assert e.value.results == [0, None, None, None]
+    executor.shutdown()
+    assert calls == [0]
+
+
+def test_run_rotational(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.fileop.rotational", lambda dev: True)
+    files = create_file([f"{i}.mkv" for i in range(6)], "src")
+    offsets = {f: (0, (i * 5) % 6) for i, f in enumerate(files)}
+    monkeypatch.setattr("peets.fileop.position", offsets.__getitem__)
+    executor = FileOpExecutor(workers=4, per_device=4)
+    lock = threading.Lock()
+    running = []
+    order = []
+
+    def op(f):
+        with lock:
+            running.append(f)
+            assert len(running) == 1
+        order.append(f)
+        time.sleep(0.005)
+        with lock:
+            running.remove(f)
+        return f.name
+
+    # 同一块机械硬盘只有一个读写流，按物理位置执行，结果仍按提交顺序返回
+    results = executor.run([(f, tmp_path.joinpath(f.name), op, (f,)) for f in files])
+    assert results == [f.name for f in files]
+    assert order == sorted(files, key=offsets.__getitem__)
+    executor.shutdown()
+
+
+def test_submit_devices(tmp_path, monkeypatch):
+    # a、b 是两块机械硬盘
+    monkeypatch.setattr("peets.fileop.rotational", lambda dev: True)
+    monkeypatch.setattr("peets.fileop._device", lambda path: ord(path.name[0]))
+    executor = FileOpExecutor(workers=2)
+    release = threading.Event()
+
+    def slow(i):
+        release.wait(5)
+        return i
+
+    a, b = tmp_path.joinpath("a"), tmp_path.joinpath("b")
+    # 等待磁盘 a 的操作不占用线程，之后提交的磁盘 b 的操作不需要等待
+    runs = [executor.submit([(a, a, slow, (i,))]) for i in range(3)]
+    assert executor.submit([(b, b, lambda: "b", ())]).result() == ["b"]
+    assert not any(r.done() for r in runs)
+
+    release.set()
+    assert [r.result() for r in runs] == [[0], [1], [2]]
+    executor.shutdown()
+
+
+def test_position(tmp_path, create_file):
+    f = create_file("a.mkv", "src")
+    f.write_bytes(os.urandom(4096))
+    kind, _ = position(f)
+    # 不支持 FIEMAP 的文件系统退回 inode
+    assert kind in (0, 1)
+    assert position(tmp_path.joinpath("missing")) == (2, 0)
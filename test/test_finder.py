@@ -1,7 +1,7 @@
 from pathlib import Path
 
 from peets.const import VIDEO_CONTAINERS
-from peets.finder import traverse
+from peets.finder import ScanSnapshot, traverse
 
 
 def test_traverse_single_file(create_file):
@@ -101,3 +101,67 @@ def test_traverse_duplicate_path(create_file, tmp_path):
     except_res = list(traverse(tmp_path))
 
     assert len(res) == len(except_res)
+
+
+def test_traverse_ignored_folder(create_file, tmp_path):
+    """
+    NAS 生成的目录不被识别
+    """
+    create_file(f"test.{VIDEO_CONTAINERS[-1]}", "@eaDir")
+    create_file(f"test.{VIDEO_CONTAINERS[-1]}", "#recycle")
+    res = traverse(tmp_path)
+    assert not any(res)
+
+
+def test_traverse_workers(create_file, tmp_path):
+    """
+    多线程遍历与单线程结果及顺序一致
+    """
+    for i in range(5):
+        create_file([f"test.{suf}" for suf in VIDEO_CONTAINERS[1:10]], f"{i}/{i}")
+
+    single = list(traverse(tmp_path, workers=1))
+    assert len(single) == 5 * 9
+    assert list(traverse(tmp_path, workers=4)) == single
+
+
+def test_traverse_incremental(create_file, tmp_path):
+    """
+    增量遍历只返回新增或修改的文件
+    """
+    files = create_file([f"test.{suf}" for suf in VIDEO_CONTAINERS[1:5]], "a/b")
+    snapshot = ScanSnapshot(tmp_path.joinpath(".scan.pickle"))
+    assert set(traverse(tmp_path, snapshot=snapshot)) == set(files)
+    snapshot.save()
+
+    snapshot = ScanSnapshot(tmp_path.joinpath(".scan.pickle"))
+    assert not any(traverse(tmp_path, snapshot=snapshot))
+
+    # 深层目录的新文件
+    new = create_file("new.mkv", "a/b")
+    assert list(traverse(tmp_path, snapshot=snapshot)) == [new]
+    # 已记录到 snapshot
+    assert not any(traverse(tmp_path, snapshot=snapshot))
+
+    # 新目录
+    new = create_file("new.mkv", "a/c")
+    assert list(traverse(tmp_path, snapshot=snapshot)) == [new]
+
+
+def test_traverse_disc(create_file, tmp_path):
+    """
+    光盘目录作为一个媒体返回，不再深入
+    """
+    create_file(["VIDEO_TS.IFO", "VTS_01_1.VOB", "VTS_01_2.VOB"], "dvd/VIDEO_TS")
+    create_file("poster.jpg", "dvd")
+    create_file(["00000.m2ts", "00001.ts"], "bluray/BDMV/STREAM")
+    # 只有 BDMV 没有 STREAM 的不认为是光盘
+    files = create_file("test.ts", "other/BDMV")
+
+    res = list(traverse(tmp_path))
+    assert res == [
+        tmp_path.joinpath("bluray"),
+        tmp_path.joinpath("dvd"),
+        files,
+    ]
+    assert list(traverse(tmp_path.joinpath("dvd"))) == [tmp_path.joinpath("dvd")]
@@ -4,7 +4,7 @@ from pytest import fixture
 from typing import cast
 
 from peets.entities import MediaEntity, MediaFileType, Movie, TvShow
-from peets.guessit import NonMedia, create_entity
+from peets.guessit import GuessCache, NonMedia, create_entities, create_entity
 from peets.ui.entry import interact
 
 
@@ -223,3 +223,181 @@ def test_create_multiple_episodes_tvshow(create_file):
         m.retrieve_episode(1, 1).multi_episode
         and m.retrieve_episode(1, 2).multi_episode
     )
+
+
+def test_create_entities(create_file):
+    files = create_file(
+        [
+            "English.Name.2020.AAC-HE_LC_8ch.mkv",
+            "Hight.Town.2020.AAC-HE_LC_8ch.sample.mkv",
+        ],
+        parent="movies",
+    )
+
+    result = list(create_entities(files))
+    assert [p for p, _ in result] == files
+    assert isinstance(result[0][1], Movie)
+    assert result[0][1].title == "English Name"
+    assert result[1][1] is NonMedia.SAMPLE
+
+
+def test_create_entities_jobs(create_file):
+    files = create_file(
+        [f"Movie.Name.{1990 + i}.1080p.mkv" for i in range(40)], parent="movies"
+    )
+
+    serial = list(create_entities(files))
+    parallel = list(create_entities(files, jobs=2))
+
+    assert [p for p, _ in parallel] == files
+    assert [(m.title, m.year) for _, m in parallel] == [
+        (m.title, m.year) for _, m in serial
+    ]
+
+
+def test_dir_index_list_once(create_file, monkeypatch):
+    import peets.guessit as guessit_
+
+    files = create_file(
+        [f"Movie.Name.{2000 + i}.1080p.mkv" for i in range(5)]
+        + [f"Movie.Name.{2000 + i}.1080p.zh.srt" for i in range(5)],
+        parent="movies",
+    )
+    listed = []
+    scan_dir = guessit_.scan_dir
+    monkeypatch.setattr(
+        guessit_, "scan_dir", lambda p: listed.append(p) or scan_dir(p)
+    )
+
+    movies = [m for _, m in create_entities(files[:5])]
+
+    assert len(listed) == 1
+    assert all(len(m.media_files) == 2 for m in movies)
+
+
+def test_guess_cache(create_file, tmp_path, monkeypatch):
+    import peets.guessit as guessit_
+
+    f = create_file("English.Name.2020.AAC-HE_LC_8ch.mkv", parent="movies")
+    cache = GuessCache(tmp_path.joinpath(".guess.db"))
+    assert cache.get(f) is None
+
+    m1 = list(create_entities([f], guess_cache=cache))[0][1]
+    assert cache.get(f) == guessit_.guess_file(f)
+
+    # 命中缓存时不再解析
+    monkeypatch.setattr(guessit_, "guess_file", None)
+    m2 = list(create_entities([f], guess_cache=cache))[0][1]
+    assert (m1.title, m1.year) == (m2.title, m2.year)
+
+    # 相对路径的解析结果不同，不共用缓存
+    monkeypatch.chdir(f.parent)
+    assert cache.get(Path(f.name)) is None
+
+    # 文件变化后缓存失效
+    f.write_bytes(b"changed")
+    assert cache.get(f) is None
+    cache.close()
+
+
+def test_create_entities_cluster_tvshow(create_file, monkeypatch):
+    import peets.guessit as guessit_
+
+    parent = "Severance.S01.2160p.ATVP.WEB-DL.DDP5.1.Atmos.HEVC-TEPES"
+    files = create_file(
+        [
+            f"Severance.S01E0{i}.2160p.ATVP.WEB-DL.DDP5.1.Atmos.HEVC-TEPES.mkv"
+            for i in range(1, 6)
+        ],
+        parent=parent,
+    )
+    flat = create_file(
+        [f"Firefly - S01E0{i}.mkv" for i in range(1, 4)], parent="downloads"
+    )
+
+    guessed = []
+    guess_file = guessit_.guess_file
+    monkeypatch.setattr(
+        guessit_, "guess_file", lambda p: guessed.append(p) or guess_file(p)
+    )
+    dirs = []
+    guessit = guessit_.guessit
+    monkeypatch.setattr(guessit_, "guessit", lambda p: dirs.append(p) or guessit(p))
+
+    result = list(create_entities(files + flat))
+
+    # 每个文件及目录只解析一次
+    assert len(guessed) == len(files + flat)
+    assert len(dirs) == len(set(dirs))
+
+    assert [p for p, _ in result] == files + flat
+    show = result[0][1]
+    assert isinstance(show, TvShow)
+    assert len(show.episodes) == 5
+    assert all(m is NonMedia.PROCESSED for _, m in result[1:5])
+
+    # 没有 tvshow 目录的 episode 按目录及标题合并
+    show = result[5][1]
+    assert isinstance(show, TvShow)
+    assert len(show.episodes) == 3
+    assert all(m is NonMedia.PROCESSED for _, m in result[6:])
+
+
+def test_create_entity_with_multi_movie_dir_mediafile(create_media):
+    files = [
+        "Movie.mkv",
+        "Movie 2.mkv",
+        "Movie.nfo",
+        "Movie-poster.jpg",
+        "Movie.zh.srt",
+        "Movie 2.nfo",
+        "Movie 2-poster.jpg",
+        "Movie 2.zh.srt",
+        "Movie 2.en.srt",
+    ]
+    movie, movie_2 = create_media(files)[:2]
+
+    assert movie.multi_movie_dir and movie_2.multi_movie_dir
+    assert set(p.name for _, p in movie.media_files) == {
+        "Movie.mkv",
+        "Movie.nfo",
+        "Movie-poster.jpg",
+        "Movie.zh.srt",
+    }
+    assert set(p.name for _, p in movie_2.media_files) == {
+        "Movie 2.mkv",
+        "Movie 2.nfo",
+        "Movie 2-poster.jpg",
+        "Movie 2.zh.srt",
+        "Movie 2.en.srt",
+    }
+
+
+def test_create_entity_with_disc(create_file, tmp_path):
+    create_file(["VIDEO_TS.IFO", "VTS_01_1.VOB"], "English.Name.2020.DVD/VIDEO_TS")
+    create_file("poster.jpg", "English.Name.2020.DVD")
+
+    movie = create_entity(tmp_path.joinpath("English.Name.2020.DVD"), set())
+    assert isinstance(movie, Movie)
+    assert movie.is_disc
+    assert movie.title == "English Name"
+    assert set(t for t, _ in movie.media_files) == {
+        MediaFileType.VIDEO,
+        MediaFileType.POSTER,
+    }
+
+
+def test_create_entities_cluster_two_shows(create_file):
+    files = create_file(
+        [f"Firefly - S01E0{i}.mkv" for i in range(1, 3)]
+        + [f"Lost - S01E0{i}.mkv" for i in range(1, 4)],
+        parent="downloads",
+    )
+
+    result = list(create_entities(files))
+
+    # 同一目录下的两部剧各合并为一个 tvshow
+    assert [p for p, _ in result] == files
+    shows = [m for _, m in result if isinstance(m, TvShow)]
+    assert [(s.title, len(s.episodes)) for s in shows] == [("Firefly", 2), ("Lost", 3)]
+    assert [m for _, m in result].count(NonMedia.PROCESSED) == 3
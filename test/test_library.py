@@ -0,0 +1,213 @@
+import os
+import pickle
+import shutil
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from peets.config import Op
+from peets.entities import MediaFileType, MediaGenres, Movie, Person, PersonType
+from peets.library import Library, Record, fingerprint
+
+
+def test_record(tmp_path, create_file):
+    src = create_file("src.mkv")
+    lib = Library(tmp_path.joinpath("lib"))
+    dest = lib.path.joinpath("movie", "dst.mkv")
+    lib.record(src, Op.Copy, dest)
+
+    # 重新打开后仍然存在
+    lib = Library(lib.path)
+    assert len(lib.records) == 1
+    r = lib.record_list[0]
+    assert (r.source, r.op, r.dest) == (src, Op.Copy, Path("movie", "dst.mkv"))
+
+
+def test_record_migrate_pickle(tmp_path):
+    lib_path = tmp_path.joinpath("lib")
+    lib_path.mkdir()
+    records = [
+        Record(Path(f"/src/{i}.mkv"), Op.Reflink, Path(f"{i}.mkv"), datetime.now())
+        for i in range(3)
+    ]
+    with lib_path.joinpath(".record.pickle").open("wb") as f:
+        pickle.dump(records, f)
+
+    lib = Library(lib_path)
+    assert lib.record_list == records
+    assert not lib_path.joinpath(".record.pickle").exists()
+
+    # 只迁移一次
+    assert Library(lib_path).record_list == records
+
+
+def test_record_query(tmp_path, create_file):
+    lib = Library(tmp_path.joinpath("lib"))
+    srcs = create_file(["a.mkv", "a.nfo", "b.mkv"], "src")
+    lib.record(srcs[0], Op.Copy, lib.path.joinpath("movie", "A", "a.mkv"))
+    lib.record(srcs[1], Op.Copy, lib.path.joinpath("movie", "A", "a.nfo"))
+    lib.record(srcs[2], Op.Copy, lib.path.joinpath("movie", "A B", "b.mkv"))
+
+    assert lib.is_processed(srcs[0])
+    assert not lib.is_processed(srcs[0].parent)
+
+    assert [r.source for r in lib.records_for(Path("movie", "A"))] == srcs[:2]
+    assert [r.source for r in lib.records_for(lib.path.joinpath("movie"))] == srcs
+    assert len(lib.records_between(datetime.min, datetime.max)) == 3
+
+    processed = lib.processed()
+    assert srcs[2] in processed
+    assert srcs[2].parent not in processed
+    processed.add(srcs[2].parent)
+    assert srcs[2].parent in processed
+
+
+def test_record_transaction(tmp_path, create_file):
+    lib = Library(tmp_path.joinpath("lib"))
+    srcs = create_file(["a.mkv", "a.nfo", "b.mkv"], "src")
+
+    with lib.transaction():
+        lib.record(srcs[0], Op.Copy, lib.path.joinpath("a.mkv"))
+        with lib.transaction():
+            lib.record(srcs[1], Op.Copy, lib.path.joinpath("a.nfo"))
+        # 未提交，其他连接看不到
+        assert len(Library(lib.path).records) == 0
+    assert len(Library(lib.path).records) == 2
+
+    try:
+        with lib.transaction():
+            lib.record(srcs[2], Op.Copy, lib.path.joinpath("b.mkv"))
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert not lib.is_processed(srcs[2])
+    assert len(Library(lib.path).records) == 2
+
+
+def test_fingerprint_duplicate(tmp_path, create_file):
+    lib = Library(tmp_path.joinpath("lib"))
+    a, b, c = create_file(["a.mkv", "b.mkv", "c.mkv"], "src")
+    content = os.urandom(1024 * 1024)
+    a.write_bytes(content)
+    b.write_bytes(content)
+    c.write_bytes(content[:-1] + b"\0")
+    assert fingerprint(a) == fingerprint(b) != fingerprint(c)
+
+    dest = lib.path.joinpath("movie", "a.mkv")
+    dest.parent.mkdir(parents=True)
+    shutil.copy(a, dest)
+    lib.record(a, Op.Copy, dest)
+
+    assert lib.find_duplicate(b) == dest
+    assert lib.find_duplicate(c) is None
+
+    movie = Movie(title="B", media_files=[(MediaFileType.VIDEO, b)])
+    assert lib.check_duplicate(movie).duplicate
+    movie = Movie(title="C", media_files=[(MediaFileType.VIDEO, c)])
+    assert not lib.check_duplicate(movie).duplicate
+
+
+def test_fingerprint_existing_library(tmp_path, create_file):
+    a, b = create_file(["a.mkv", "b.mkv"], "src")
+    content = os.urandom(1024 * 1024)
+    a.write_bytes(content)
+    b.write_bytes(content)
+    lib_path = tmp_path.joinpath("lib")
+    dest = lib_path.joinpath("movie", "a.mkv")
+    dest.parent.mkdir(parents=True)
+    shutil.copy(a, dest)
+    # 没有 fingerprint 表的旧 library
+    with sqlite3.connect(lib_path.joinpath(".record.db")) as conn:
+        conn.execute(
+            "CREATE TABLE record (id INTEGER PRIMARY KEY, source TEXT NOT NULL,"
+            " op TEXT NOT NULL, dest TEXT NOT NULL, date TEXT NOT NULL)"
+        )
+        conn.execute(
+            "INSERT INTO record VALUES (1, ?, 'Copy', 'movie/a.mkv', ?)",
+            (str(a), datetime.now().isoformat()),
+        )
+    conn.close()
+
+    assert Library(lib_path).find_duplicate(b) == dest
+
+
+def test_fingerprint_rebuild_once(tmp_path, create_file, monkeypatch):
+    src = create_file("VIDEO_TS.IFO", "src/disc/VIDEO_TS")
+    lib = Library(tmp_path.joinpath("lib"))
+    lib.record(src, Op.Copy, lib.path.joinpath("movie", "VIDEO_TS"))
+
+    # 没有可索引的视频，fingerprint 表为空，再次打开时也不再遍历记录
+    def rebuild(*args):
+        pytest.fail("rebuilt again")
+
+    monkeypatch.setattr("peets.library._rebuild_fingerprints", rebuild)
+    assert len(Library(lib.path).record_list) == 1
+
+
+def test_fingerprint_migrate_pickle(tmp_path, create_file):
+    a, b = create_file(["a.mkv", "b.mkv"], "src")
+    content = os.urandom(1024 * 1024)
+    a.write_bytes(content)
+    b.write_bytes(content)
+    lib_path = tmp_path.joinpath("lib")
+    dest = lib_path.joinpath("movie", "a.mkv")
+    dest.parent.mkdir(parents=True)
+    shutil.copy(a, dest)
+    with lib_path.joinpath(".record.pickle").open("wb") as f:
+        pickle.dump([Record(a, Op.Copy, Path("movie", "a.mkv"), datetime.now())], f)
+
+    assert Library(lib_path).find_duplicate(b) == dest
+
+
+def test_library_lazy(tmp_path):
+    lib = Library(tmp_path.joinpath("lib"))
+    assert not lib.path.exists()
+    assert "manager" not in vars(lib)
+
+    # 不再探测整个库是否支持 reflink
+    assert lib.config.op is Op.Reflink
+    assert not lib.path.exists()
+
+
+def test_entity_snapshot(tmp_path, create_file):
+    video = create_file("Title.2022.mkv", "src")
+    movie = Movie(
+        title="Title",
+        year=2022,
+        genres=[MediaGenres.ACTION],
+        actors=[Person(PersonType.ACTOR, "A", "B")],
+        media_files=[(MediaFileType.VIDEO, video)],
+    )
+    lib = Library(tmp_path.joinpath("lib"))
+    dest = lib.path.joinpath("movie", "Title (2022)", "Title (2022)")
+    lib.snapshot(movie, dest, video)
+
+    lib = Library(lib.path)
+    assert lib.entity(dest) == movie
+    assert lib.entity(Path("movie", "Title (2022)", "Title (2022)")) == movie
+    assert lib.entity_of(video) == movie
+    assert lib.entity(Path("missing")) is None
+
+
+def test_record_digest_column(tmp_path, create_file):
+    lib_path = tmp_path.joinpath("lib")
+    lib_path.mkdir()
+    # 没有 digest 列的旧数据库
+    with sqlite3.connect(lib_path.joinpath(".record.db")) as conn:
+        conn.execute(
+            "CREATE TABLE record (id INTEGER PRIMARY KEY, source TEXT NOT NULL,"
+            " op TEXT NOT NULL, dest TEXT NOT NULL, date TEXT NOT NULL)"
+        )
+        conn.execute(
+            "INSERT INTO record (source, op, dest, date) VALUES (?, ?, ?, ?)",
+            ("/src/a.mkv", "Copy", "a.mkv", datetime.now().isoformat()),
+        )
+    conn.close()
+
+    lib = Library(lib_path)
+    assert lib.record_list[0].digest is None
+    src = create_file("b.srt", "src")
+    lib.record(src, Op.Copy, lib.path.joinpath("b.srt"), "00ff")
+    assert Library(lib_path).record_list[1].digest == "00ff"
@@ -1,9 +1,20 @@
+import os
+import signal
 import stat
+import threading
+import time
 from os import chmod
+from pathlib import Path
 
-from peets.entities import MediaFileType, Movie
+import pytest
+
+from peets.config import Op
+from peets.entities import MediaFileType, Movie, TvShowEpisode
+from peets.fileop import FileOpError, FileOpExecutor
 from peets.library import Library
-from peets.naming import do_copy
+from peets.naming import Batch, BatchQueue, do_copy
+from peets.transfer import file_digest
+from peets.ui.entry import _do_process
 
 
 def test_do_copy_simple_naming(tmp_path, create_file):
@@ -52,6 +63,10 @@ def test_do_copy_simple_naming(tmp_path, create_file):
         main_video.stat().st_mode
     )
 
+    snapshot = lib.entity(parent.joinpath("Title (2022) 2160p AAC"))
+    assert snapshot.title == "Title"
+    assert snapshot.main_video() == parent.joinpath("Title (2022) 2160p AAC.mkv")
+
 
 def test_do_copy(tmp_path, create_file):
     media_files = [
@@ -97,3 +112,262 @@ def test_do_copy(tmp_path, create_file):
             "Title (2022) 2160p AAC-banner.jpg",
         ]
     )
+
+
+def test_do_copy_disc(tmp_path, create_file):
+    create_file(["VIDEO_TS.IFO", "VTS_01_1.VOB"], "src/Title.2022.DVD/VIDEO_TS")
+    poster = create_file("poster.jpg", "src/Title.2022.DVD")
+    disc = poster.parent
+
+    movie = Movie(
+        title="Title",
+        year=2022,
+        is_disc=True,
+        media_files=[(MediaFileType.VIDEO, disc), (MediaFileType.POSTER, poster)],
+    )
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.naming_template = "{type}/{title} ({year})/{title} ({year})"
+    do_copy(movie, lib)
+
+    parent = lib.path.joinpath("movie", "Title (2022)")
+    assert set(f.name for f in parent.iterdir()) == {"VIDEO_TS", "poster.jpg"}
+    assert set(f.name for f in parent.joinpath("VIDEO_TS").iterdir()) == {
+        "VIDEO_TS.IFO",
+        "VTS_01_1.VOB",
+    }
+    assert lib.record_list[0].source == disc
+
+
+def test_do_copy_move(tmp_path, create_file):
+    video, nfo = create_file(["Title.2022.mkv", "Title.2022.nfo"], "src")
+    movie = Movie(
+        title="Title",
+        year=2022,
+        media_files=[(MediaFileType.VIDEO, video), (MediaFileType.NFO, nfo)],
+    )
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.naming_template = "{type}/{title} ({year})/{title} ({year})"
+    lib.config.op = Op.Move
+    do_copy(movie, lib)
+
+    parent = lib.path.joinpath("movie", "Title (2022)")
+    assert {f.name for f in parent.iterdir()} == {"Title (2022).mkv", "movie.nfo"}
+    assert not video.exists() and not nfo.exists()
+    assert [(r.source, r.op) for r in lib.record_list] == [
+        (video, Op.Move),
+        (nfo, Op.Move),
+    ]
+
+
+def test_do_copy_checksum(tmp_path, create_file, capsys):
+    video, nfo = create_file(["Title.2022.mkv", "Title.2022.nfo"], "src")
+    video.write_bytes(b"video")
+    movie = Movie(
+        title="Title",
+        year=2022,
+        media_files=[(MediaFileType.VIDEO, video), (MediaFileType.NFO, nfo)],
+    )
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.op = Op.Copy
+    lib.config.checksum = True
+    lib.config.verify = True
+    do_copy(movie, lib)
+
+    records = Library(lib.path).record_list
+    assert records[0].digest == file_digest(video)
+    assert records[1].digest == file_digest(nfo)
+    # 计算 digest 时经过用户态复制
+    out = capsys.readouterr().out
+    assert f"copy {video} -> " in out
+    assert out.count("via readinto") == 2
+
+
+def test_do_copy_verify(tmp_path, create_file, monkeypatch):
+    video, nfo = create_file(["Title.2022.mkv", "Title.2022.nfo"], "src")
+    video.write_bytes(b"video")
+    movie = Movie(
+        title="Title",
+        year=2022,
+        media_files=[(MediaFileType.VIDEO, video), (MediaFileType.NFO, nfo)],
+    )
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.op = Op.Copy
+    lib.config.verify = True
+    do_copy(movie, lib)
+    assert Library(lib.path).record_list[0].digest == file_digest(video)
+
+    # 跨设备 move 时记录复制时计算的 digest
+    lib = Library(tmp_path.joinpath("moved"))
+    lib.config.op = Op.Move
+    lib.config.checksum = True
+    monkeypatch.setattr("peets.transfer.same_device", lambda *_: False)
+    do_copy(movie, lib)
+    record = Library(lib.path).record_list[0]
+    assert record.digest == file_digest(lib.path.joinpath(record.dest))
+
+
+def test_do_copy_batch(tmp_path, create_file):
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.naming_template = "{type}/{title} ({year})/{title} ({year})"
+    lib.config.op = Op.Copy
+    batch = Batch()
+    videos = create_file(["A.2021.mkv", "B.2022.mkv"], "src")
+    for v, year in zip(videos, (2021, 2022)):
+        movie = Movie(
+            title=v.stem[0], year=year, media_files=[(MediaFileType.VIDEO, v)]
+        )
+        do_copy(movie, lib, batch)
+    # 只加入 batch，不执行
+    assert not lib.record_list
+
+    batch.run(lib)
+    assert [r.source for r in lib.record_list] == videos
+    assert lib.path.joinpath("movie", "B (2022)", "B (2022).mkv").exists()
+    assert lib.entity(Path("movie", "A (2021)", "A (2021)")).title == "A"
+
+
+def test_do_copy_move_multi_episode(tmp_path, create_file):
+    video = create_file("Show.S01E01E02.mkv", "src")
+    video.write_bytes(b"video")
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.naming_template = "{title} S{season:02d}E{episode:02d}"
+    lib.config.op = Op.Move
+    batch = Batch()
+    for i in (1, 2):
+        episode = TvShowEpisode(
+            title="Show",
+            season=1,
+            episode=i,
+            media_files=[(MediaFileType.VIDEO, video)],
+        )
+        do_copy(episode, lib, batch)
+    batch.run(lib)
+
+    # 源文件只移动一次，第二集从库中的文件链接
+    assert not video.exists()
+    for i in (1, 2):
+        assert lib.path.joinpath(f"Show S01E0{i}.mkv").read_bytes() == b"video"
+    assert [(r.source, r.op) for r in lib.record_list] == [
+        (video, Op.Move),
+        (video, Op.Hardlink),
+    ]
+
+
+def test_do_copy_existing_dest(tmp_path, create_file):
+    a = create_file("Title.2022.mkv", "src/a")
+    b = create_file("Title.2022.mkv", "src/b")
+    a.write_bytes(b"a")
+    b.write_bytes(b"b")
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.naming_template = "{type}/{title} ({year})/{title} ({year})"
+    lib.config.op = Op.Move
+    movies = [
+        Movie(title="Title", year=2022, media_files=[(MediaFileType.VIDEO, v)])
+        for v in (a, b)
+    ]
+    dest = lib.path.joinpath("movie", "Title (2022)", "Title (2022).mkv")
+
+    # 同一个 batch 中的两个操作不能写入同一个目标
+    batch = Batch()
+    do_copy(movies[0], lib, batch)
+    with pytest.raises(FileExistsError):
+        do_copy(movies[1], lib, batch)
+
+    # 不覆盖库中已有的文件
+    do_copy(movies[0], lib)
+    with pytest.raises(FileExistsError):
+        do_copy(movies[1], lib)
+    assert dest.read_bytes() == b"a"
+    assert b.exists()
+    assert [r.source for r in lib.record_list] == [a]
+
+
+def test_process_move_partial_failure(tmp_path, create_file):
+    video, nfo = create_file(["Title.2022.mkv", "Title.2022.nfo"], "src")
+    missing = tmp_path.joinpath("src", "Title.2022-poster.jpg")
+    movie = Movie(
+        title="Title",
+        year=2022,
+        media_files=[
+            (MediaFileType.VIDEO, video),
+            (MediaFileType.NFO, nfo),
+            (MediaFileType.POSTER, missing),
+        ],
+    )
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.naming_template = "{type}/{title} ({year})/{title} ({year})"
+    lib.config.op = Op.Move
+    with pytest.raises(FileOpError):
+        _do_process(movie, lib)
+
+    # 已经移动到库中的文件仍然有记录
+    assert not video.exists()
+    assert [r.source for r in Library(lib.path).record_list] == [video, nfo]
+    assert lib.is_processed(video)
+
+
+def test_batch_interrupt(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.fileop.rotational", lambda dev: True)
+    executor = FileOpExecutor()
+    monkeypatch.setattr("peets.naming.default_executor", lambda: executor)
+    a, b = create_file(["a.mkv", "b.mkv"], "src")
+    lib = Library(tmp_path.joinpath("dst"))
+
+    def op(src, dst):
+        if src == a:
+            time.sleep(0.05)
+            os.kill(os.getpid(), signal.SIGINT)
+            time.sleep(0.05)
+        return (src, Op.Move, dst)
+
+    batch = Batch()
+    for f in (a, b):
+        batch.add(f, lib.path.joinpath(f.name), op, f, lib.path.joinpath(f.name))
+    with pytest.raises(KeyboardInterrupt):
+        batch.run(lib)
+    # 中断前完成的操作有记录，之后的操作不再执行
+    assert [r.source for r in Library(lib.path).record_list] == [a]
+    executor.shutdown()
+
+
+def test_batch_queue(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.fileop.rotational", lambda dev: False)
+    executor = FileOpExecutor()
+    monkeypatch.setattr("peets.naming.default_executor", lambda: executor)
+    lib = Library(tmp_path.joinpath("dst"))
+    lib.config.naming_template = "{type}/{title} ({year})/{title} ({year})"
+    lib.config.op = Op.Copy
+    a, b = create_file(["A.2021.mkv", "B.2022.mkv"], "src")
+    release = threading.Event()
+    queue = BatchQueue(lib)
+
+    def wait(src, dst):
+        release.wait(5)
+        return (src, Op.Copy, dst)
+
+    slow = Batch()
+    dest = lib.path.joinpath("slow.mkv")
+    slow.claim(dest)
+    slow.add(a, dest, wait, a, dest)
+    queue.submit(slow)
+
+    # submit 后立即返回，已完成的 batch 单独记录
+    batch = Batch()
+    movie = Movie(title="B", year=2022, media_files=[(MediaFileType.VIDEO, b)])
+    do_copy(movie, lib, batch)
+    queue.submit(batch)
+    while not batch.done():
+        time.sleep(0.01)
+    queue.commit()
+    assert [r.source for r in lib.record_list] == [b]
+
+    # 与尚未完成的 batch 的目标冲突
+    conflict = Batch()
+    conflict.claim(dest)
+    with pytest.raises(FileExistsError):
+        queue.submit(conflict)
+
+    release.set()
+    queue.close()
+    assert [r.source for r in lib.record_list] == [b, a]
+    executor.shutdown()
@@ -0,0 +1,363 @@
+import errno
+import json
+from hashlib import blake2b
+import os
+import stat
+from os import chmod
+
+import pytest
+
+from reflink import ReflinkImpossibleError
+
+from peets import transfer
+from peets.config import Op
+from peets.transfer import (
+    Digest,
+    clone,
+    copy,
+    copy_file,
+    file_digest,
+    hardlink,
+    move,
+)
+
+
+@pytest.fixture(autouse=True)
+def capabilities(monkeypatch):
+    # 能力缓存是全局的，测试之间隔离
+    monkeypatch.setattr("peets.transfer._unsupported", {})
+
+
+def test_move_same_device(tmp_path, create_file):
+    src = create_file("a.mkv", "src")
+    ino = src.stat().st_ino
+    dst = tmp_path.joinpath("a.mkv")
+    move(src, dst)
+    assert not src.exists()
+    assert dst.stat().st_ino == ino
+
+
+def _exdev(src, dst):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+
+def test_move_cross_device(tmp_path, create_file, monkeypatch):
+    src = create_file("a.mkv", "src")
+    src.write_bytes(os.urandom(512 * 1024))
+    content = src.read_bytes()
+    disc = create_file(["VIDEO_TS.IFO", "VTS_01_1.VOB"], "src/disc/VIDEO_TS")[0].parent
+    monkeypatch.setattr("os.rename", _exdev)
+
+    dst = tmp_path.joinpath("a.mkv")
+    assert move(src, dst) == file_digest(dst)
+    assert not src.exists()
+    assert dst.read_bytes() == content
+
+    assert move(disc, tmp_path.joinpath("VIDEO_TS")) is None
+    assert not disc.exists()
+    assert {f.name for f in tmp_path.joinpath("VIDEO_TS").iterdir()} == {
+        "VIDEO_TS.IFO",
+        "VTS_01_1.VOB",
+    }
+
+
+def test_move_rollback(tmp_path, create_file, monkeypatch):
+    src = create_file("a.mkv", "src")
+    src.write_bytes(os.urandom(2 * 1024 * 1024))
+    monkeypatch.setattr("os.rename", _exdev)
+    real_digest = transfer.file_digest
+
+    def corrupted(path, drop_cache=False):
+        # 损坏不在 fingerprint 采样范围内的字节
+        with open(path, "r+b") as f:
+            f.seek(1024 * 1024 + 1)
+            byte = f.read(1)
+            f.seek(1024 * 1024 + 1)
+            f.write(b"\0" if byte != b"\0" else b"\1")
+        return real_digest(path, drop_cache)
+
+    monkeypatch.setattr("peets.transfer.file_digest", corrupted)
+
+    dst = tmp_path.joinpath("a.mkv")
+    with pytest.raises(OSError):
+        move(src, dst)
+    assert src.exists()
+    assert not dst.exists()
+    assert not tmp_path.joinpath("a.mkv.moving").exists()
+
+
+def test_move_keep_existing(tmp_path, create_file, monkeypatch):
+    src = create_file("a.mkv", "src")
+    disc = create_file(["VTS_01_1.VOB"], "src/disc/VIDEO_TS")[0].parent
+    existing = create_file(["VIDEO_TS.IFO"], "lib/VIDEO_TS")[0]
+    dst = create_file("a.mkv", "lib")
+    dst.write_bytes(b"old")
+
+    # 同一设备的 rename 也不能覆盖已存在的 dst
+    for s, d in ((src, dst), (disc, existing.parent)):
+        with pytest.raises(FileExistsError):
+            move(s, d)
+    monkeypatch.setattr("os.rename", _exdev)
+    for s, d in ((src, dst), (disc, existing.parent)):
+        with pytest.raises(FileExistsError):
+            move(s, d)
+    assert src.exists() and disc.exists() and existing.exists()
+    assert dst.read_bytes() == b"old"
+
+
+def test_hardlink(tmp_path, create_file, monkeypatch):
+    src = create_file("a.mkv", "src")
+    dst = tmp_path.joinpath("a.mkv")
+    assert hardlink(src, dst) == (Op.Hardlink, None)
+    assert dst.stat().st_ino == src.stat().st_ino
+
+    monkeypatch.setattr("os.link", _exdev)
+    monkeypatch.setattr("peets.transfer.reflink", _exdev_reflink)
+    dst = tmp_path.joinpath("b.mkv")
+    op, method = hardlink(src, dst)
+    assert op is Op.Copy and method in ("copy_file_range", "sendfile")
+    assert dst.stat().st_ino != src.stat().st_ino
+
+
+def _exdev_reflink(src, dst):
+    raise ReflinkImpossibleError("EXDEV")
+
+
+def _enosys(*args):
+    raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+
+def test_copy_file(tmp_path, create_file, monkeypatch):
+    src = create_file("a.mkv", "src")
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    src.write_bytes(content)
+    chmod(src, 0o640)
+
+    dst = tmp_path.joinpath("a.mkv")
+    assert copy(src, dst) in ("copy_file_range", "sendfile")
+    assert dst.read_bytes() == content
+    assert stat.S_IMODE(dst.stat().st_mode) == 0o640
+
+    monkeypatch.setattr("os.copy_file_range", _enosys)
+    assert copy_file(src, dst) == "sendfile"
+    assert dst.read_bytes() == content
+    monkeypatch.setattr("os.copy_file_range", lambda *args: pytest.fail("cached"))
+    assert copy_file(src, dst) == "sendfile"
+
+    monkeypatch.setattr("os.sendfile", _enosys)
+    monkeypatch.setattr("peets.transfer._BUFFER_SIZE", 1 << 20)
+    assert copy_file(src, dst) == "readinto"
+    assert dst.read_bytes() == content
+
+
+def test_copy_file_resume_fallback(tmp_path, create_file, monkeypatch):
+    src = create_file("a.mkv", "src")
+    content = os.urandom(1024 * 1024)
+    src.write_bytes(content)
+    copy_file_range = os.copy_file_range
+
+    def partial(fin, fout, count, offset_src, offset_dst):
+        # 只完成前半部分，之后失败
+        if offset_src:
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return copy_file_range(fin, fout, len(content) // 2, offset_src, offset_dst)
+
+    monkeypatch.setattr("os.copy_file_range", partial)
+    dst = tmp_path.joinpath("a.mkv")
+    assert copy_file(src, dst) == "sendfile"
+    assert dst.read_bytes() == content
+
+
+def _enotsock(*args):
+    raise OSError(errno.ENOTSOCK, os.strerror(errno.ENOTSOCK))
+
+
+def test_copy_file_platform(tmp_path, create_file, monkeypatch):
+    src = create_file("a.mkv", "src")
+    content = os.urandom(1024 * 1024)
+    src.write_bytes(content)
+    dst = tmp_path.joinpath("a.mkv")
+
+    # 如 macOS，没有 copy_file_range，sendfile 只支持 socket
+    monkeypatch.delattr("os.copy_file_range")
+    monkeypatch.setattr("os.sendfile", _enotsock)
+    monkeypatch.setattr(
+        "peets.transfer._METHODS",
+        [m for m in transfer._METHODS if m[0] != "copy_file_range"],
+    )
+    assert copy_file(src, dst) == "readinto"
+    assert dst.read_bytes() == content
+
+    # 没有 preadv/pwrite
+    monkeypatch.setattr("peets.transfer._METHODS", [])
+    monkeypatch.setattr("peets.transfer._READINTO", False)
+    dst.unlink()
+    digest = Digest()
+    assert copy_file(src, dst, digest) == "copyfile"
+    assert dst.read_bytes() == content
+    assert digest.hexdigest() == blake2b(content, digest_size=32).hexdigest()
+
+
+def test_clone_fallback(tmp_path, create_file, monkeypatch):
+    calls = []
+
+    def reflink(src, dst):
+        calls.append(src)
+        raise ReflinkImpossibleError("EOPNOTSUPP")
+
+    monkeypatch.setattr("peets.transfer.reflink", reflink)
+    a, b = create_file(["a.mkv", "b.srt"], "src")
+    assert clone(a, tmp_path.joinpath("a.mkv"))[0] is Op.Copy
+    assert tmp_path.joinpath("a.mkv").exists()
+    # 同一设备组合不再尝试 reflink
+    assert clone(b, tmp_path.joinpath("b.srt"))[0] is Op.Copy
+    assert len(calls) == 1
+
+
+def test_copy_file_stream(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.transfer._STREAM_THRESHOLD", 1 << 20)
+    monkeypatch.setattr("peets.transfer._STREAM_CHUNK", 256 * 1024)
+    advised = []
+    fadvise = os.posix_fadvise
+
+    def posix_fadvise(fd, offset, length, advice):
+        if advice == os.POSIX_FADV_DONTNEED:
+            advised.append((offset, length))
+        fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr("os.posix_fadvise", posix_fadvise)
+    src = create_file("a.mkv", "src")
+    content = os.urandom(1024 * 1024 + 100)
+    src.write_bytes(content)
+
+    dst = tmp_path.joinpath("a.mkv")
+    copy_file(src, dst)
+    assert dst.read_bytes() == content
+    # 每块丢弃源和目标
+    assert len(advised) == 5 * 2
+    assert advised[-1] == (1024 * 1024, 100)
+
+
+def test_copy_file_stream_platform(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.transfer._STREAM_THRESHOLD", 1 << 20)
+    monkeypatch.setattr("peets.transfer._STREAM_CHUNK", 256 * 1024)
+    # 如 macOS，没有 posix_fallocate、posix_fadvise、fdatasync
+    for name in ("posix_fallocate", "posix_fadvise", "fdatasync"):
+        monkeypatch.delattr(os, name)
+    src = create_file("a.mkv", "src")
+    content = os.urandom(1024 * 1024 + 100)
+    src.write_bytes(content)
+
+    dst = tmp_path.joinpath("a.mkv")
+    digest = Digest()
+    copy_file(src, dst, digest)
+    assert dst.read_bytes() == content
+    assert file_digest(dst, drop_cache=True) == digest.hexdigest()
+
+
+def test_copy_file_resume(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.transfer._STREAM_THRESHOLD", 1 << 20)
+    monkeypatch.setattr("peets.transfer._STREAM_CHUNK", 256 * 1024)
+    src = create_file("a.mkv", "src")
+    content = os.urandom(1024 * 1024 + 100)
+    src.write_bytes(content)
+    dst = tmp_path.joinpath("a.mkv")
+
+    copy_range = transfer._copy_range
+    copied = []
+
+    def interrupted(fin, fout, offset, end, devices, digest=None):
+        if len(copied) == 2:
+            raise KeyboardInterrupt
+        copied.append(offset)
+        return copy_range(fin, fout, offset, end, devices, digest)
+
+    monkeypatch.setattr("peets.transfer._copy_range", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        copy_file(src, dst)
+    assert not dst.exists()
+    assert tmp_path.joinpath("a.mkv.part.ckpt").exists()
+
+    # 从第 3 块继续
+    copied.clear()
+
+    def resumed(fin, fout, offset, end, devices, digest=None):
+        copied.append(offset)
+        return copy_range(fin, fout, offset, end, devices, digest)
+
+    monkeypatch.setattr("peets.transfer._copy_range", resumed)
+    copy_file(src, dst)
+    assert copied[0] == 512 * 1024
+    assert dst.read_bytes() == content
+    assert not tmp_path.joinpath("a.mkv.part").exists()
+    assert not tmp_path.joinpath("a.mkv.part.ckpt").exists()
+
+
+def test_copy_file_resume_corrupted(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.transfer._STREAM_THRESHOLD", 1 << 20)
+    monkeypatch.setattr("peets.transfer._STREAM_CHUNK", 256 * 1024)
+    src = create_file("a.mkv", "src")
+    content = os.urandom(1024 * 1024)
+    src.write_bytes(content)
+    dst = tmp_path.joinpath("a.mkv")
+
+    copy_range = transfer._copy_range
+
+    def interrupted(fin, fout, offset, end, devices, digest=None):
+        if offset:
+            raise KeyboardInterrupt
+        return copy_range(fin, fout, offset, end, devices, digest)
+
+    monkeypatch.setattr("peets.transfer._copy_range", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        copy_file(src, dst)
+    # .part 被修改后从头开始
+    with tmp_path.joinpath("a.mkv.part").open("r+b") as f:
+        f.seek(256 * 1024 - 1)
+        f.write(b"\0" if content[256 * 1024 - 1] else b"\1")
+    monkeypatch.setattr("peets.transfer._copy_range", copy_range)
+    copy_file(src, dst)
+    assert dst.read_bytes() == content
+
+
+def test_copy_digest(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.transfer._STREAM_THRESHOLD", 1 << 20)
+    monkeypatch.setattr("peets.transfer._STREAM_CHUNK", 256 * 1024)
+    small, large = create_file(["small.srt", "large.mkv"], "src")
+    small.write_bytes(b"subtitle")
+    large.write_bytes(os.urandom(1024 * 1024 + 100))
+
+    digest = Digest()
+    copy_file(small, tmp_path.joinpath("small.srt"), digest)
+    assert digest.hexdigest() == blake2b(b"subtitle", digest_size=32).hexdigest()
+
+    digest = Digest()
+    dst = tmp_path.joinpath("large.mkv")
+    assert copy_file(large, dst, digest) == "readinto"
+    assert digest.hexdigest() == file_digest(large) == file_digest(dst)
+    dst.write_bytes(large.read_bytes()[:-1] + b"\0")
+    assert file_digest(dst) != digest.hexdigest()
+
+
+def test_copy_digest_resume(tmp_path, create_file, monkeypatch):
+    monkeypatch.setattr("peets.transfer._STREAM_THRESHOLD", 1 << 20)
+    monkeypatch.setattr("peets.transfer._STREAM_CHUNK", 256 * 1024)
+    src = create_file("a.mkv", "src")
+    src.write_bytes(os.urandom(1024 * 1024))
+    dst = tmp_path.joinpath("a.mkv")
+    copy_range = transfer._copy_range
+
+    def interrupted(fin, fout, offset, end, devices, digest=None):
+        if offset >= 512 * 1024:
+            raise KeyboardInterrupt
+        return copy_range(fin, fout, offset, end, devices, digest)
+
+    monkeypatch.setattr("peets.transfer._copy_range", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        copy_file(src, dst, Digest())
+    saved = json.loads(tmp_path.joinpath("a.mkv.part.ckpt").read_text())
+    assert saved["offset"] == 512 * 1024 and saved["digest"]
+    monkeypatch.setattr("peets.transfer._copy_range", copy_range)
+    digest = Digest()
+    copy_file(src, dst, digest)
+    assert digest.hexdigest() == file_digest(src)
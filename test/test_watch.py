@@ -0,0 +1,81 @@
+import sys
+
+from pytest import mark
+
+from peets.__main__ import watch_main
+from peets.entities import TvShow
+from peets.ui import Action
+from peets.watch import IN_Q_OVERFLOW, Watcher
+
+pytestmark = mark.skipif(sys.platform != "linux", reason="inotify is linux only")
+
+
+def test_watch_close_write(tmp_path):
+    watcher = Watcher(tmp_path, settle=0.1)
+    it = iter(watcher)
+
+    f = tmp_path.joinpath("test.mkv")
+    f.write_bytes(b"data")
+    tmp_path.joinpath("test.txt").write_bytes(b"data")
+    assert next(it) == f
+    watcher.close()
+
+
+def test_watch_move_in_folder(tmp_path):
+    """
+    移入的目录及其子目录都被监听
+    """
+    src = tmp_path.joinpath("src", "show")
+    src.mkdir(parents=True)
+    src.joinpath("e01.mkv").write_bytes(b"data")
+    dst = tmp_path.joinpath("dst")
+    dst.mkdir()
+
+    watcher = Watcher(dst, settle=0.1)
+    it = iter(watcher)
+    src.rename(dst.joinpath("show"))
+    assert next(it) == dst.joinpath("show", "e01.mkv")
+
+    f = dst.joinpath("show", "e02.mkv")
+    f.write_bytes(b"data")
+    assert next(it) == f
+    watcher.close()
+
+
+def test_watch_overflow(tmp_path, monkeypatch):
+    """
+    队列溢出后重新扫描，已存在的文件也会被返回
+    """
+    f = tmp_path.joinpath("show", "e01.mkv")
+    f.parent.mkdir()
+    f.write_bytes(b"data")
+    watcher = Watcher(tmp_path, settle=0.1)
+    monkeypatch.setattr(watcher._inotify, "read", lambda: [(-1, IN_Q_OVERFLOW, "")])
+    watcher._handle()
+    monkeypatch.undo()
+
+    assert next(iter(watcher)) == f
+    watcher.close()
+
+
+def test_watch_main_episodes(tmp_path, create_file, monkeypatch):
+    """
+    同一 tvshow 的 episode 先后到达，都会被处理，
+    已创建的 tvshow 目录不会使之后的 episode 被忽略
+    """
+    files = create_file(
+        [f"Severance.S01E0{i}.2160p.ATVP.WEB-DL.mkv" for i in (1, 2)],
+        "Severance.S01.2160p.ATVP.WEB-DL",
+    )
+    monkeypatch.setattr("peets.watch.watch", lambda *args, **kwargs: iter(files))
+    processed = []
+
+    def interact(media, lib):
+        processed.append(media)
+        return Action.NEXT
+
+    monkeypatch.setattr("peets.ui.entry.interact", interact)
+    watch_main(["-l", str(tmp_path.joinpath("lib")), str(files[0].parent)])
+
+    assert [type(m) for m in processed] == [TvShow, TvShow]
+    assert [m.episodes[0].episode for m in processed] == [1, 2]